@@ -2,7 +2,11 @@
 TODO
 """
 
-from .base import route_permutations, hashable_list
+from .base import route_permutations, iter_route_permutations, hashable_list
+from .base import reverse_graph, target_distances, shortest_path_tree, iter_routes_by_length, iter_shortest_routes
+from .base import iter_simple_paths, partition_graph
+from .base import strongly_connected_components, condense_graph
+from .base import count_routes, RouteCounter
 from depend_test_framework.log import get_logger
 
 LOGGER = get_logger(__name__)
@@ -2,6 +2,8 @@
 Some small algorithms
 """
 
+import collections
+
 from depend_test_framework.log import get_logger
 
 LOGGER = get_logger(__name__)
@@ -14,54 +16,410 @@ def route_permutations(graph, start, target,
     Help to compute all the permutations of the way in the graph
     TODO: Use some package which related to graph based machine learning
     """
-    routes = []
-    nodes_map = graph[start]
+    return list(iter_route_permutations(graph, start, target, pb=pb,
+                                        allow_dep=allow_dep, trace=trace,
+                                        history=history, dep=dep))
+
 
-    if not trace:
-        new_trace = set([start])
-    else:
-        new_trace = set(trace)
-        new_trace.add(start)
+def iter_route_permutations(graph, start, target, pb=None, allow_dep=None,
+                            trace=None, history=None, dep=None, dist=None, comps=None):
+    """
+    Same as route_permutations, but yield the routes one by one. A route
+    doesn't pass a node twice and has at most allow_dep - dep edges.
 
+    The nodes which cannot reach the target with the edges left are
+    skipped by the distances to the target. The routes are kept in a
+    table of (edge data, next key) which is expanded lazily, the key of
+    a node is (node, edges left, the trace nodes which can still be
+    passed), so a table is right for every route which use it. Only the
+    trace nodes in the same strongly connected component (comps) can be
+    passed again, so the routes between the components are shared.
+    """
+    max_dep = (allow_dep or len(graph)) - (dep or 0)
+    if dist is None:
+        dist = target_distances(graph, target, max_dep=max_dep)
     if history is None:
         history = {}
+    trace = set(trace or ())
+    trace.add(start)
+    if start == target or dist.get(start, max_dep + 1) > max_dep:
+        return iter(())
+    if comps is None:
+        comps = strongly_connected_components(graph)
+    nodes = set()
+
+    def _key(node, left):
+        comp = comps[node]
+        return (node, left, frozenset(tmp_node for tmp_node in trace
+                                      if comps[tmp_node] == comp and
+                                      dist.get(tmp_node, left) < left))
+
+    root_key = _key(start, max_dep)
+    if root_key not in history:
+        # frame: [node, edges left, key, edge iterator, table, the edge
+        # which is waiting for the table of its next node]
+        stack = [[start, max_dep, root_key, iter(graph[start].items()), [], None]]
+        while stack:
+            frame = stack[-1]
+            node, left, key, edges, table, waiting = frame
+            if waiting is not None:
+                opaque, next_node, next_key = waiting
+                trace.discard(next_node)
+                if history[next_key]:
+                    table.append((opaque, next_key))
+                frame[5] = None
+            for next_node, opaque in edges:
+                if next_node in trace:
+                    continue
+                if next_node == target:
+                    table.append((opaque, None))
+                    continue
+                if dist.get(next_node, left) >= left:
+                    continue
+                trace.add(next_node)
+                next_key = _key(next_node, left - 1)
+                if next_key in history:
+                    trace.discard(next_node)
+                    if history[next_key]:
+                        table.append((opaque, next_key))
+                    continue
+                frame[5] = (opaque, next_node, next_key)
+                stack.append([next_node, left - 1, next_key,
+                              iter(graph[next_node].items()), [], None])
+                break
+            else:
+                history[key] = table
+                nodes.add(node)
+                if pb:
+                    pb.update(len(nodes))
+                stack.pop()
+
+    return _expand_route_table(history, root_key)
+
 
-    # TODO better way to limit the table
-    if allow_dep:
-        dep = dep or 0
-        if dep >= allow_dep:
-            return routes
+def _expand_route_table(history, key):
+    route = []
+    stack = [iter(history[key])]
+    while stack:
+        for opaque, next_key in stack[-1]:
+            route.append(opaque)
+            if next_key is None:
+                yield list(route)
+                route.pop()
+            else:
+                stack.append(iter(history[next_key]))
+                break
         else:
-            dep += 1
+            stack.pop()
+            if route:
+                route.pop()
+
+
+def reverse_graph(graph):
+    """
+    return {node: set(the nodes which have a edge to the node)}
+    """
+    rgraph = dict((node, set()) for node in graph)
+    for node, nodes_map in graph.items():
+        for tgt_node in nodes_map:
+            rgraph[tgt_node].add(node)
+    return rgraph
 
-    for node, opaque in nodes_map.items():
-        if node in new_trace:
+
+def target_distances(graph, target, rgraph=None, max_dep=None):
+    """
+    return {node: the least edges from the node to the target}, the nodes
+    which cannot reach the target in max_dep edges are not included
+    """
+    if rgraph is None:
+        rgraph = reverse_graph(graph)
+    dist = {target: 0}
+    queue = collections.deque([target])
+    while queue:
+        node = queue.popleft()
+        new_dist = dist[node] + 1
+        if max_dep and new_dist > max_dep:
             continue
-        if node in history.keys():
-            ret = history[node]
+        for src_node in rgraph[node]:
+            if src_node not in dist:
+                dist[src_node] = new_dist
+                queue.append(src_node)
+    return dist
+
+
+def strongly_connected_components(graph):
+    """
+    return {node: component index} of the strongly connected components
+    by Tarjan's algorithm with a explicit stack. A component is found
+    after all the components it can reach, so a edge never goes to a
+    component with a bigger index
+    """
+    index = {}
+    low = {}
+    comps = {}
+    stack = []
+    on_stack = set()
+    num = 0
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, next_nodes = work[-1]
+            for next_node in next_nodes:
+                if next_node not in index:
+                    index[next_node] = low[next_node] = len(index)
+                    stack.append(next_node)
+                    on_stack.add(next_node)
+                    work.append((next_node, iter(graph[next_node])))
+                    break
+                elif next_node in on_stack:
+                    low[node] = min(low[node], index[next_node])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        tmp_node = stack.pop()
+                        on_stack.discard(tmp_node)
+                        comps[tmp_node] = num
+                        if tmp_node == node:
+                            break
+                    num += 1
+    return comps
+
+
+def condense_graph(graph, comps=None):
+    """
+    return the DAG of the strongly connected components:
+    {component index: set(the next component indexes)}
+    """
+    if comps is None:
+        comps = strongly_connected_components(graph)
+    dag = dict((comp, set()) for comp in comps.values())
+    for node, nodes_map in graph.items():
+        for tgt_node in nodes_map:
+            if comps[tgt_node] != comps[node]:
+                dag[comps[node]].add(comps[tgt_node])
+    return dag
+
+
+def shortest_path_tree(graph, start, max_dep=None):
+    """
+    return ({node: the least edges from start}, {node: parent node}) of a
+    BFS from start, the nodes which need more than max_dep edges are not
+    included
+    """
+    dist = {start: 0}
+    parents = {}
+    queue = collections.deque([start])
+    while queue:
+        node = queue.popleft()
+        new_dist = dist[node] + 1
+        if max_dep and new_dist > max_dep:
+            continue
+        for tgt_node in graph[node]:
+            if tgt_node not in dist:
+                dist[tgt_node] = new_dist
+                parents[tgt_node] = node
+                queue.append(tgt_node)
+    return dist, parents
+
+
+def partition_graph(graph, observe):
+    """
+    return {node: block index}, the nodes in a block have the same
+    observe() and the edges with the same data go to the same block,
+    so they cannot be told apart by any route
+    """
+    keys = {}
+    blocks = {}
+    for node in graph:
+        blocks[node] = keys.setdefault(observe(node), len(keys))
+    num = None
+    # split the blocks until nothing changes
+    while num != len(keys):
+        num = len(keys)
+        keys = {}
+        new_blocks = {}
+        for node, nodes_map in graph.items():
+            sign = (blocks[node], frozenset((data, blocks[tgt_node])
+                                            for tgt_node, datas in nodes_map.items()
+                                            for data in datas))
+            new_blocks[node] = keys.setdefault(sign, len(keys))
+        blocks = new_blocks
+    return blocks
+
+
+def iter_routes_by_length(graph, start, target, length, dist=None):
+    """
+    Yield the routes from start to target which have exactly length edges,
+    no node is passed twice. dist is the result of target_distances, it
+    help to skip the nodes which cannot reach the target in time
+    """
+    if dist is None:
+        dist = target_distances(graph, target, max_dep=length)
+    if start == target or dist.get(start, length + 1) > length:
+        return iter(())
+    return _iter_paths(graph, start, target, length, dist, exact=True)
+
+
+def iter_simple_paths(graph, start, end, max_len, end_dist, avoid=()):
+    """
+    Yield the node lists of the paths from start to end which have at
+    most max_len edges and don't pass a node twice or a node in avoid.
+    end_dist is the result of target_distances of end.
+    """
+    if start in avoid or end_dist.get(start, max_len + 1) > max_len:
+        return iter(())
+    if start == end:
+        return iter([[start]])
+    return _iter_paths(graph, start, end, max_len, end_dist, avoid, with_nodes=True)
+
+
+def _iter_paths(graph, start, end, max_len, dist, avoid=(), exact=False,
+                with_nodes=False):
+    """
+    Walk the paths from start to end with a explicit stack, yield the edge
+    datas of the paths, or the nodes when with_nodes
+    """
+    trace = set([start])
+    path = [start]
+    route = []
+    stack = [iter(graph[start].items())]
+    while stack:
+        left = max_len - len(route)
+        for next_node, opaque in stack[-1]:
+            if next_node in trace or next_node in avoid:
+                continue
+            if next_node == end:
+                if not exact or left == 1:
+                    if with_nodes:
+                        yield path + [next_node]
+                    else:
+                        route.append(opaque)
+                        yield list(route)
+                        route.pop()
+                continue
+            if dist.get(next_node, left) >= left:
+                continue
+            trace.add(next_node)
+            path.append(next_node)
+            route.append(opaque)
+            stack.append(iter(graph[next_node].items()))
+            break
         else:
-            if node == target:
-                routes.append([opaque])
+            stack.pop()
+            if route:
+                route.pop()
+                trace.discard(path.pop())
+
+
+def iter_shortest_routes(graph, start, target, allow_dep=None):
+    """
+    Yield the routes from start to target from the shortest one, like
+    iter_routes_by_length for length 1, 2, ... allow_dep
+    """
+    max_dep = allow_dep or len(graph)
+    dist = target_distances(graph, target, max_dep=max_dep)
+    for length in range(1, max_dep + 1):
+        for route in iter_routes_by_length(graph, start, target, length, dist):
+            yield route
+
+
+def count_routes(graph, start, target, allow_dep=None, weight=len, dist=None, comps=None):
+    """
+    Return the number of the routes which iter_shortest_routes yields,
+    every route is counted as the product of the weight of its edge datas
+    """
+    return RouteCounter(graph, target, allow_dep, weight, dist, comps).count(start)
+
+
+class RouteCounter(object):
+    """
+    Count the routes to a target like count_routes and sample them. The
+    result of a node is memorized by the steps left and the nodes of the
+    trace which may still be passed, so it can be shared by the queries.
+    Like iter_route_permutations, only the trace nodes in the strongly
+    connected component of the node are kept in the memo key.
+    """
+    def __init__(self, graph, target, allow_dep=None, weight=len, dist=None, comps=None):
+        self._graph = graph
+        self._target = target
+        self._max_dep = allow_dep or len(graph)
+        self._weight = weight
+        if dist is None:
+            dist = target_distances(graph, target, max_dep=self._max_dep)
+        self._dist = dist
+        if comps is None:
+            comps = strongly_connected_components(graph)
+        self._comps = comps
+        self._memo = {}
+
+    def _edges(self, node, left, trace):
+        """
+        yield (next node, edge data, number of the routes through the edge)
+        """
+        dist = self._dist
+        for next_node, opaque in self._graph[node].items():
+            if next_node in trace:
                 continue
-            else:
-                ret = route_permutations(graph,
-                    node, target, new_trace, history,
-                    pb, allow_dep, dep)
-        if ret:
-            for sub_route in ret:
-                tmp_route = [opaque]
-                tmp_route.extend(sub_route)
-                routes.append(tmp_route)
-
-    del(new_trace)
-    history[start] = routes
-    if pb:
-        pb.update(len(history))
-    # LOGGER.info("Trace: %s", trace)
-    # LOGGER.info("Map: %s", nodes_map)
-    # LOGGER.info("Start: %s", start)
-    # LOGGER.info("routes: %s", routes)
-    return routes
+            if next_node == self._target:
+                yield next_node, opaque, self._weight(opaque)
+                continue
+            if dist.get(next_node, left) >= left:
+                continue
+            trace.add(next_node)
+            num = self._count(next_node, left - 1, trace)
+            trace.discard(next_node)
+            if num:
+                yield next_node, opaque, self._weight(opaque) * num
+
+    def _count(self, node, left, trace):
+        dist = self._dist
+        comps = self._comps
+        comp = comps[node]
+        key = (node, left, frozenset(tmp_node for tmp_node in trace
+                                     if comps[tmp_node] == comp and
+                                     dist.get(tmp_node, left) < left))
+        num = self._memo.get(key)
+        if num is None:
+            num = self._memo[key] = sum(data[2] for data in self._edges(node, left, trace))
+        return num
+
+    def count(self, start):
+        if start == self._target or start not in self._dist:
+            return 0
+        return self._count(start, self._max_dep, set([start]))
+
+    def sample(self, start, rand):
+        """
+        return a random route as a list of edge datas, the probability of a
+        route is in proportion to its count, None if there is no route
+        """
+        if not self.count(start):
+            return
+        trace = set([start])
+        node = start
+        left = self._max_dep
+        route = []
+        while True:
+            num = rand.randrange(self._count(node, left, trace))
+            for next_node, opaque, sub_num in self._edges(node, left, trace):
+                if num < sub_num:
+                    break
+                num -= sub_num
+            route.append(opaque)
+            if next_node == self._target:
+                return route
+            trace.add(next_node)
+            node = next_node
+            left -= 1
 
 
 class hashable_list(list):
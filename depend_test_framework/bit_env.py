@@ -0,0 +1,260 @@
+"""
+Bitset encoded env, every env path get a bit index and a env state
+become a int mask, so the Consumer/Provider of the test functions can
+be compiled into masks and checked by bitwise operations
+"""
+
+from .log import get_logger
+from .env import EnvState
+from .dependency import Consumer, Provider, Cut, Graft, Migrate, get_all_depend
+
+LOGGER = get_logger(__name__)
+
+MAX_PATH_DEPTH = 32
+
+
+class PathBits(object):
+    """
+    Registry of the env paths and their bit index
+    """
+    def __init__(self):
+        self._bits = {}
+        self._paths = []
+        self._subtree = {}
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path):
+        return path in self._bits
+
+    def register(self, path):
+        """
+        register the path and all its parents, return the bit of the path
+        """
+        for i in range(1, len(path) + 1):
+            sub_path = path[:i]
+            if sub_path not in self._bits:
+                self._bits[sub_path] = len(self._paths)
+                self._paths.append(sub_path)
+                self._subtree = {}
+        return self.bit(path)
+
+    def bit(self, path):
+        return 1 << self._bits[path]
+
+    def path(self, index):
+        return self._paths[index]
+
+    def paths(self, prefix=()):
+        for path in self._paths:
+            if path[:len(prefix)] == prefix:
+                yield path
+
+    def subtree(self, path):
+        """
+        return the mask of the path and all its descendants
+        """
+        mask = self._subtree.get(path)
+        if mask is None:
+            mask = 0
+            for sub_path in self.paths(path):
+                mask |= self.bit(sub_path)
+            self._subtree[path] = mask
+        return mask
+
+
+class CompiledFunc(object):
+    """
+    Consumer and Provider/Graft/Cut of a function compiled into masks
+    """
+    __slots__ = ('func', 'require_masks', 'require_n_mask',
+                 'require_n_groups', 'effects')
+
+    def __init__(self, func):
+        self.func = func
+        # every mask must hit at least one bit
+        self.require_masks = []
+        # all of the bits must be zero
+        self.require_n_mask = 0
+        # at least one mask in a group must be zero
+        self.require_n_groups = []
+        self.effects = []
+
+    def hit(self, mask):
+        if mask & self.require_n_mask:
+            return False
+        for require_mask in self.require_masks:
+            if not mask & require_mask:
+                return False
+        for group in self.require_n_groups:
+            for require_mask in group:
+                if not mask & require_mask:
+                    break
+            else:
+                return False
+        return True
+
+    def apply(self, mask):
+        for clear_mask, set_mask, pairs in self.effects:
+            new_mask = (mask & ~clear_mask) | set_mask
+            for src_bit, tgt_bit in pairs:
+                if mask & src_bit:
+                    new_mask |= tgt_bit
+            mask = new_mask
+        return mask
+
+
+class BitEnvEngine(object):
+    """
+    Compile the test functions and transfer the int mask states, the
+    paths of the states (like the start state) are registered too
+    """
+    def __init__(self, funcs, states=()):
+        self.path_bits = PathBits()
+        self._compiled = {}
+        self._states = {}
+        funcs = list(funcs)
+        for state in states:
+            for path in EnvState.from_env(state).set_paths():
+                self.path_bits.register(path)
+        for func in funcs:
+            for depend in get_all_depend(func, depend_cls=(Consumer, Provider)):
+                for path in depend.alternatives:
+                    self.path_bits.register(path)
+            for obj in get_all_depend(func, depend_cls=Cut):
+                self.path_bits.register(obj.src_path)
+        self._register_grafts(funcs)
+        for func in funcs:
+            self.compile(func)
+
+    def _register_grafts(self, funcs):
+        grafts = []
+        for func in funcs:
+            for obj in get_all_depend(func, depend_cls=Graft):
+                grafts.append((obj.src_path, obj.tgt_path))
+                self.path_bits.register(obj.src_path)
+                self.path_bits.register(obj.tgt_path)
+
+        # the paths under the graft source can appear under the graft target
+        num = None
+        while num != len(self.path_bits):
+            num = len(self.path_bits)
+            for src, tgt in grafts:
+                for path in list(self.path_bits.paths(src)):
+                    new_path = tgt + path[len(src):]
+                    if len(new_path) > MAX_PATH_DEPTH:
+                        raise Exception('Graft %s -> %s create too deep path' % (src, tgt))
+                    self.path_bits.register(new_path)
+
+    def compile(self, func):
+        compiled = self._compiled.get(func)
+        if compiled is not None:
+            return compiled
+
+        bits = self.path_bits
+        compiled = CompiledFunc(func)
+        for con in get_all_depend(func, depend_cls=Consumer):
+            masks = [bits.subtree(path) for path in con.alternatives]
+            if con.type == Consumer.REQUIRE:
+                require_mask = 0
+                for mask in masks:
+                    require_mask |= mask
+                compiled.require_masks.append(require_mask)
+            elif con.type == Consumer.REQUIRE_N:
+                if len(masks) == 1:
+                    compiled.require_n_mask |= masks[0]
+                else:
+                    compiled.require_n_groups.append(tuple(masks))
+            else:
+                raise NotImplementedError
+
+        for obj in get_all_depend(func, depend_cls=(Provider, Graft, Cut)):
+            compiled.effects.append(self._compile_effect(obj))
+
+        self._compiled[func] = compiled
+        return compiled
+
+    def _compile_effect(self, obj):
+        """
+        return (clear mask, set mask, [(src bit, tgt bit), ...])
+        """
+        bits = self.path_bits
+        if isinstance(obj, Provider):
+            bit = bits.bit(obj.path)
+            if obj.type == Provider.SET:
+                return 0, bit, ()
+            elif obj.type == Provider.CLEAR:
+                return bit, 0, ()
+            raise NotImplementedError
+        elif isinstance(obj, Cut):
+            return bits.subtree(obj.src_path), 0, ()
+        elif isinstance(obj, Graft):
+            src = obj.src_path
+            tgt = obj.tgt_path
+            pairs = tuple((bits.bit(path), bits.bit(tgt + path[len(src):]))
+                          for path in bits.paths(src))
+            clear_mask = bits.subtree(tgt)
+            if isinstance(obj, Migrate):
+                clear_mask |= bits.subtree(src)
+            return clear_mask, 0, pairs
+        raise NotImplementedError
+
+    def transfer(self, mask, func):
+        """
+        return transfered mask Or Null if not suit
+        """
+        compiled = self.compile(func)
+        if not compiled.hit(mask):
+            return
+        return compiled.apply(mask)
+
+    def size(self, mask):
+        """
+        same as len() of the EnvState, the number of the set leaves
+        """
+        bits = self.path_bits
+        num = 0
+        index = 0
+        tmp_mask = mask
+        while tmp_mask:
+            if tmp_mask & 1:
+                bit = 1 << index
+                if not mask & bits.subtree(bits.path(index)) & ~bit:
+                    num += 1
+            tmp_mask >>= 1
+            index += 1
+        return num
+
+    def encode(self, env):
+        """
+        return the mask of a Env or EnvState
+        """
+        mask = 0
+        stack = [((), EnvState.from_env(env))]
+        while stack:
+            path, state = stack.pop()
+            if state.data and path:
+                mask |= self.path_bits.bit(path)
+            for key, value in state.items():
+                stack.append((path + (key,), value))
+        return mask
+
+    def decode(self, mask):
+        """
+        return the EnvState of a mask
+        """
+        state = self._states.get(mask)
+        if state is not None:
+            return state
+        paths = []
+        index = 0
+        tmp_mask = mask
+        while tmp_mask:
+            if tmp_mask & 1:
+                paths.append(self.path_bits.path(index))
+            tmp_mask >>= 1
+            index += 1
+
+        state = self._states[mask] = EnvState.from_paths(paths)
+        return state
@@ -2,53 +2,168 @@
 Helper classes to help generate case
 """
 
+import hashlib
+import heapq
 import itertools
+import json
+import multiprocessing
+import os
 import random
+import zlib
 
 from progressbar import ProgressBar, SimpleProgress, Counter, Timer
 
 from .log import get_logger
-from .env import Env
+from .env import Env, EnvState, TRANSITION_CACHE
+from .bit_env import BitEnvEngine
+from .graph import IdGraph
 from .utils import pretty
 from .case import Case
-from .algorithms import route_permutations
+from .base_class import get_entrypoint
+from .dependency import Dependency, Graft, Cut, compile_path, get_func_paths, slice_depends
+from .algorithms import iter_route_permutations, iter_routes_by_length, iter_shortest_routes
+from .algorithms import reverse_graph, target_distances, shortest_path_tree, RouteCounter
+from .algorithms import iter_simple_paths, partition_graph, strongly_connected_components
 
 LOGGER = get_logger(__name__)
 
+# bump this when the graph or the cache file format changed
+GRAPH_CACHE_VERSION = 1
+GRAPH_CACHE_DIR = '.dep_graph_cache'
+
+
+def get_func_name(func):
+    name = getattr(func, '__name__', None) or func.__class__.__name__
+    return '%s.%s' % (getattr(func, '__module__', None), name)
+
+
+def get_func_signature(func):
+    """
+    return the metadata of the function which can effect the depend graph
+    """
+    entrys = []
+    for entry in get_entrypoint(func) or ():
+        if isinstance(entry, Dependency):
+            entrys.append((entry.__class__.__name__, entry.env_depend, entry.type))
+        elif isinstance(entry, Graft):
+            entrys.append((entry.__class__.__name__, entry.src, entry.tgt))
+        elif isinstance(entry, Cut):
+            entrys.append((entry.__class__.__name__, entry.src))
+    return get_func_name(func), sorted(entrys)
+
+
+# the functions and the bitset engine of the worker processes
+_WORKER_DATA = None
+
+
+def _get_fork_context():
+    """
+    return the multiprocessing context which fork the workers, None if
+    the platform cannot fork
+    """
+    get_start_methods = getattr(multiprocessing, 'get_all_start_methods', None)
+    if get_start_methods is None:
+        # python2 always fork on posix
+        return multiprocessing if os.name == 'posix' else None
+    if 'fork' not in get_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def _init_expand_worker(test_funcs, engine):
+    global _WORKER_DATA
+    _WORKER_DATA = test_funcs, engine
+
+
+def _expand_worker(args):
+    """
+    transfer a batch of states by all the functions, the states are the
+    int masks when the engine is given, otherwise the set paths
+    """
+    states, drop_env = args
+    test_funcs, engine = _WORKER_DATA
+    ret = []
+    for state in states:
+        node = state if engine else EnvState.from_paths(state)
+        edges = []
+        for i, func in enumerate(test_funcs):
+            if engine:
+                new_node = engine.transfer(node, func)
+            else:
+                new_node = node.gen_transfer_env(func)
+            if new_node is None:
+                continue
+            if engine:
+                if drop_env and engine.size(new_node) > drop_env:
+                    continue
+                edges.append((i, new_node))
+            else:
+                if drop_env and len(new_node) > drop_env:
+                    continue
+                edges.append((i, tuple(sorted(new_node.set_paths()))))
+        ret.append(edges)
+    return ret
+
 
 class DependGraphCaseGenerator(object):
     """
     Case generator which use a directed graph to describe
     the dependency of the work items
     """
-    def __init__(self, suit_env_limit=20, allow_dep=8, use_map=True):
+    def __init__(self, suit_env_limit=20, allow_dep=8, use_map=True,
+                 use_bitset=False, cleanup_weight=None, use_por=False):
         self.dep_graph = None
         self._allow_dep = allow_dep
         self._suit_env_limit = suit_env_limit
+        # use the int mask states when expanding the graph
+        self._use_bitset = use_bitset
+        self._suit_index = None
+        # cost of the functions when find the cleanup steps, default is 1
+        self._cleanup_weight = cleanup_weight
+        self._cleanup_planner = None
+        # only keep one order of the independent steps in gen_cases
+        self._use_por = use_por
+        self._por = PartialOrderReducer()
+        # key of the functions and options used to gen the graph
+        self._graph_key = None
+        self._graph_funcs = None
+        self._drop_env = None
+        self._start_node = None
+        # {concrete state: the state stands for it} of a minimized graph
+        self._state_map = None
+        # project the concrete states to the paths which the targets read
+        self._projector = None
+        # the functions to clean the concrete envs of a projected graph
+        self._cleanup_funcs = None
 
         # graph objs mapping
         self._use_map = use_map
-        self._nodes_map = []
-        self._edge_map = []
-        self._v_graph = None
+        self.id_graph = None
+        self._reverse_graph = None
+        self._distances = {}
+        self._counters = {}
+        self._components = None
 
     def find_suit_envs(self, env):
         env_list = env if type(env) is list else [env]
         if not self.dep_graph:
             raise Exception('Need gen depend graph first')
-        env_record = []
+        if self._suit_index is None:
+            self._suit_index = SubsumptionIndex(self.dep_graph)
+        env_record = set()
         for tmp_env in env_list:
-            tmp_list = []
-            for key_env in self.dep_graph.keys():
-                if tmp_env <= key_env:
-                    tmp_list.append(key_env)
-
-            for i, tgt_env in enumerate(sorted(tmp_list, key=len)):
+            for i, tgt_env in enumerate(self._suit_index.find(tmp_env)):
                 if i <= self._suit_env_limit and tgt_env not in env_record:
-                    env_record.append(tgt_env)
+                    env_record.add(tgt_env)
                     yield tgt_env
 
     def compute_route_permutations(self, src_env, target_env, cleanup=False):
+        return list(self.iter_route_permutations(src_env, target_env, cleanup))
+
+    def iter_route_permutations(self, src_env, target_env, cleanup=False):
+        """
+        Same as compute_route_permutations, but yield the cases one by one
+        """
         if not self.dep_graph:
             raise Exception('Need gen depend graph first')
 
@@ -56,88 +171,679 @@ class DependGraphCaseGenerator(object):
         # TODO encapsulation the ProgressBar in utils
         widgets = ['Processed: ', Counter(), ' of %d (' % len(self.dep_graph), Timer(), ')']
         pbar = ProgressBar(widgets=widgets, maxval=len(self.dep_graph)).start()
-        graph = self._v_graph if self._use_map else self.dep_graph
-        src_node = self._nodes_map.index(src_env) if self._use_map else src_env
-        tgt_node = self._nodes_map.index(target_env) if self._use_map else target_env
+        graph = self.id_graph if self._use_map else self.dep_graph
+        src_env = EnvState.from_env(src_env)
+        target_env = EnvState.from_env(target_env)
+        src_node = self._graph_node(src_env)
+        tgt_node = self._graph_node(target_env)
         if cleanup:
-            routes = route_permutations(graph, tgt_node, src_node, pb=pbar, allow_dep=self._allow_dep)
-        else:
-            routes = route_permutations(graph, src_node, tgt_node, pb=pbar, allow_dep=self._allow_dep)
+            src_node, tgt_node = tgt_node, src_node
+        routes = iter_route_permutations(graph, src_node, tgt_node, pb=pbar, allow_dep=self._allow_dep,
+                                         dist=self._target_distances(tgt_node),
+                                         comps=self._graph_components())
         pbar.finish()
 
-        ret_routes = []
         for route in routes:
-            ret_routes.extend(itertools.product(*route))
-        return ret_routes
+            for case in itertools.product(*route):
+                yield case
 
     def gen_cases(self, test_func, random_cleanup=False, need_cleanup=False, src_env=None):
-        if not src_env:
-            src_env = Env()
+        src_env = EnvState.from_env(src_env) if src_env else EnvState.EMPTY
         target_env = list(Env.gen_require_env(test_func))
         for tgt_env in self.find_suit_envs(target_env):
-            cases = self.compute_route_permutations(src_env, tgt_env)
-            if not tgt_env.gen_transfer_env(test_func):
+            new_tgt_env = tgt_env.gen_transfer_env(test_func)
+            if not new_tgt_env:
                 LOGGER.info('Cannot use env %s for testing', tgt_env)
                 continue
 
-            if need_cleanup:
-                new_tgt_env = tgt_env.gen_transfer_env(test_func)
+            if need_cleanup and self._projector is None:
                 cleanup_steps = self.gen_cleanups(new_tgt_env, src_env, random_cleanup)
             else:
                 cleanup_steps = None
 
-            LOGGER.debug("env: %s case num: %d" % (tgt_env, len(cases)))
-            for case in cases:
+            case_num = 0
+            for case in self.iter_route_permutations(src_env, tgt_env):
                 tmp_case = self.restore_onigin_data(case)
-                case_obj = Case(tmp_case, tgt_env=tgt_env,
+                if self._use_por and not self._keep_order(src_env, tgt_env, tmp_case):
+                    continue
+                if need_cleanup and self._projector is not None:
+                    cleanup_steps = self._projected_cleanups(src_env, tmp_case, test_func,
+                                                             random_cleanup)
+                case_obj = Case(tmp_case, tgt_env=self.restore_env(src_env, tgt_env, tmp_case),
                                 cleanups=cleanup_steps)
+                case_num += 1
                 yield case_obj
+            LOGGER.debug("env: %s case num: %d", tgt_env, case_num)
 
-    def gen_cleanups(self, src_env, tgt_env, random_cleanup=False):
-        cleanups = self.compute_route_permutations(tgt_env, src_env, True)
-        if cleanups:
-            if random_cleanup:
-                cleanup_steps = random.choice(cleanups)
+    def _graph_state(self, env):
+        if self._projector is not None:
+            env = self._projector(env)
+        if self._state_map is None:
+            return env
+        return self._state_map.get(env, env)
+
+    def _graph_node(self, env):
+        env = self._graph_state(env)
+        return self.id_graph.node_id(env) if self._use_map else env
+
+    def restore_env(self, src_env, tgt_env, steps):
+        """
+        return the env after the steps from src_env, in a minimized or
+        projected graph tgt_env only stands for it
+        """
+        if self._state_map is None and self._projector is None:
+            return tgt_env
+        env = EnvState.from_env(src_env)
+        for step in steps:
+            env = env.gen_transfer_env(step)
+        return env
+
+    def _projected_cleanups(self, src_env, steps, test_func, random_cleanup=False):
+        """
+        return the cleanups of a case in a projected graph, the graph does
+        not know the paths which are written but not read, so they are
+        planned from the env which the steps and test_func really reach
+        """
+        env = self.restore_env(src_env, None, steps).gen_transfer_env(test_func)
+        return self.gen_cleanups(env, src_env, random_cleanup)
+
+    def _target_distances(self, tgt_node):
+        dist = self._distances.get(tgt_node)
+        if dist is None:
+            graph = self.id_graph if self._use_map else self.dep_graph
+            if self._reverse_graph is None:
+                self._reverse_graph = reverse_graph(graph)
+            dist = target_distances(graph, tgt_node, self._reverse_graph,
+                                    self._allow_dep or len(graph))
+            self._distances[tgt_node] = dist
+        return dist
+
+    def _graph_components(self):
+        """
+        return {node: index of its strongly connected component}
+        """
+        if self._components is None:
+            graph = self.id_graph if self._use_map else self.dep_graph
+            self._components = strongly_connected_components(graph)
+            LOGGER.info('Depend map has %d strongly connected components',
+                        len(set(self._components.values())))
+        return self._components
+
+    def _find_test_envs(self, test_func):
+        """
+        yield the (env, env after test_func) which test_func can use
+        """
+        for tgt_env in self.find_suit_envs(list(Env.gen_require_env(test_func))):
+            new_tgt_env = tgt_env.gen_transfer_env(test_func)
+            if not new_tgt_env:
+                LOGGER.info('Cannot use env %s for testing', tgt_env)
+                continue
+            yield tgt_env, new_tgt_env
+
+    def count_route_permutations(self, src_env, target_env):
+        """
+        return the number of the cases from src_env to target_env which
+        gen_shortest_cases yields, without enumerating them
+        """
+        if not self.dep_graph:
+            raise Exception('Need gen depend graph first')
+        tgt_node = self._graph_node(EnvState.from_env(target_env))
+        return self._route_counter(tgt_node).count(self._graph_node(EnvState.from_env(src_env)))
+
+    def _route_counter(self, tgt_node):
+        counter = self._counters.get(tgt_node)
+        if counter is None:
+            graph = self.id_graph if self._use_map else self.dep_graph
+            counter = self._counters[tgt_node] = RouteCounter(
+                graph, tgt_node, self._allow_dep, dist=self._target_distances(tgt_node),
+                comps=self._graph_components())
+        return counter
+
+    def count_cases(self, test_func, src_env=None):
+        """
+        return the number of the cases of gen_shortest_cases without max_cases
+        """
+        src_env = EnvState.from_env(src_env) if src_env else EnvState.EMPTY
+        return sum(self.count_route_permutations(src_env, tgt_env)
+                   for tgt_env, _ in self._find_test_envs(test_func))
+
+    def gen_sample_cases(self, test_func, sample_num, seed=None, random_cleanup=False,
+                         need_cleanup=False, src_env=None):
+        """
+        Yield sample_num different cases of gen_shortest_cases which are
+        chosen randomly, every case has the same probability. The routes
+        are drawn by the case counts, the cases are not enumerated.
+        """
+        if not self.dep_graph:
+            raise Exception('Need gen depend graph first')
+        rand = random.Random(seed)
+        src_env = EnvState.from_env(src_env) if src_env else EnvState.EMPTY
+        src_node = self._graph_node(src_env)
+        targets = []
+        total = 0
+        for tgt_env, new_tgt_env in self._find_test_envs(test_func):
+            tgt_node = self._graph_node(tgt_env)
+            counter = self._route_counter(tgt_node)
+            num = counter.count(src_node)
+            if num:
+                targets.append([tgt_env, new_tgt_env, counter, num, None, tgt_node])
+                total += num
+        LOGGER.info('Sample %d cases from %d cases', min(sample_num, total), total)
+
+        def _gen_case(target, steps):
+            steps = self.restore_onigin_data(steps)
+            if need_cleanup and self._projector is not None:
+                cleanup_steps = self._projected_cleanups(src_env, steps, test_func,
+                                                         random_cleanup) or []
             else:
-                cleanup_steps = min(cleanups, key=len)
-            return self.restore_onigin_data(cleanup_steps)
+                if need_cleanup and target[4] is None:
+                    target[4] = self.gen_cleanups(target[1], src_env, random_cleanup) or []
+                cleanup_steps = target[4]
+            return Case(steps, tgt_env=self.restore_env(src_env, target[0], steps),
+                        cleanups=cleanup_steps)
+
+        if sample_num * 2 >= total:
+            # most of the cases are needed, choose from all of them
+            graph = self.id_graph if self._use_map else self.dep_graph
+            cases = []
+            for target in targets:
+                for route in iter_shortest_routes(graph, src_node, target[5], self._allow_dep):
+                    route = [sorted(datas, key=self._data_key) for datas in route]
+                    for steps in itertools.product(*route):
+                        cases.append((target, steps))
+            for target, steps in rand.sample(cases, min(sample_num, total)):
+                yield _gen_case(target, steps)
+            return
+
+        used = set()
+        while len(used) < sample_num:
+            num = rand.randrange(total)
+            for target in targets:
+                if num < target[3]:
+                    break
+                num -= target[3]
+            route = target[2].sample(src_node, rand)
+            steps = tuple(rand.choice(sorted(datas, key=self._data_key)) for datas in route)
+            if (target[0], steps) in used:
+                continue
+            used.add((target[0], steps))
+            yield _gen_case(target, steps)
+
+    def gen_cover_cases(self, test_func, random_cleanup=False, need_cleanup=False,
+                        src_env=None):
+        """
+        Yield a small set of cases which pass every (env, function, new env)
+        edge that a route of gen_shortest_cases can pass. Every case is the
+        shortest route through a edge which is not passed yet, the edges
+        which are not passed are preferred on the way.
+        """
+        if not self.dep_graph:
+            raise Exception('Need gen depend graph first')
+        src_env = EnvState.from_env(src_env) if src_env else EnvState.EMPTY
+        graph = self.id_graph if self._use_map else self.dep_graph
+        max_dep = self._allow_dep or len(graph)
+        src_node = self._graph_node(src_env)
+        src_dist, parents = shortest_path_tree(graph, src_node, max_dep)
+
+        targets = []
+        for tgt_env, new_tgt_env in self._find_test_envs(test_func):
+            tgt_node = self._graph_node(tgt_env)
+            dist = self._target_distances(tgt_node)
+            if src_node != tgt_node and src_node in dist:
+                targets.append([tgt_env, new_tgt_env, tgt_node, dist, None])
+
+        # (node, data, next node): [(length of the case, target index)]
+        edges = {}
+        for node, node_dist in sorted(src_dist.items(), key=lambda x: x[1]):
+            for next_node, datas in graph[node].items():
+                if next_node == src_node:
+                    continue
+                choices = []
+                for i, target in enumerate(targets):
+                    if node == target[2] or next_node not in target[3]:
+                        continue
+                    length = node_dist + 1 + target[3][next_node]
+                    if length <= max_dep:
+                        choices.append((length, i))
+                if choices:
+                    choices.sort()
+                    for data in sorted(datas, key=self._data_key):
+                        edges[(node, data, next_node)] = choices
+        LOGGER.info('Find %d edges to cover', len(edges))
+
+        covered = set()
+        for edge in sorted(edges, key=lambda x: -edges[x][0][0]):
+            if edge in covered:
+                continue
+            node, data, next_node = edge
+            for _, i in edges[edge]:
+                target = targets[i]
+                nodes = self._find_cover_route(graph, src_node, edge, target[2], target[3],
+                                               parents, covered, max_dep)
+                if nodes is not None:
+                    break
+            if nodes is None:
+                LOGGER.debug('Cannot find a route pass %s', edge)
+                continue
+            route = []
+            for i in range(len(nodes) - 1):
+                if (nodes[i], nodes[i + 1]) == (node, next_node):
+                    route.append(edge)
+                else:
+                    route.append((nodes[i], self._choose_edge(graph, nodes[i], [nodes[i + 1]],
+                                                              covered)[0], nodes[i + 1]))
+            covered.update(route)
+
+            steps = self.restore_onigin_data([step[1] for step in route])
+            if need_cleanup and self._projector is not None:
+                cleanup_steps = self._projected_cleanups(src_env, steps, test_func,
+                                                         random_cleanup) or []
+            else:
+                if need_cleanup and target[4] is None:
+                    target[4] = self.gen_cleanups(target[1], src_env, random_cleanup) or []
+                cleanup_steps = target[4]
+            yield Case(steps, tgt_env=self.restore_env(src_env, target[0], steps),
+                       cleanups=cleanup_steps)
+
+    def gen_nwise_cases(self, test_func, n=2, random_cleanup=False, need_cleanup=False,
+                        src_env=None):
+        """
+        Yield the cases of gen_shortest_cases which have a ordered
+        combination of n steps that the yielded cases don't have
+        """
+        cases = self.gen_shortest_cases(test_func, random_cleanup=random_cleanup,
+                                        need_cleanup=need_cleanup, src_env=src_env)
+        return NWiseCaseSelector(n).select(cases)
+
+    def _keep_order(self, src_env, tgt_env, steps):
+        """
+        return True if the steps are the normal order of the independent
+        steps, or the normal order is not a route of the graph
+        """
+        normal_steps = self._por.normal_form(steps)
+        if normal_steps == list(steps):
+            return True
+        return not self._is_route(src_env, tgt_env, normal_steps)
+
+    def _is_route(self, src_env, tgt_env, steps):
+        """
+        return True if the steps go from src_env to tgt_env in the graph
+        without passing a env twice
+        """
+        env = src_env
+        node = self._graph_state(env)
+        trace = set([node])
+        for i, step in enumerate(steps):
+            env = env.gen_transfer_env(step)
+            if env is None:
+                return False
+            new_node = self._graph_state(env)
+            if step not in self.dep_graph.get(node, {}).get(new_node, ()):
+                return False
+            if new_node in trace or (new_node == tgt_env and i != len(steps) - 1):
+                return False
+            trace.add(new_node)
+            node = new_node
+        return node == tgt_env
+
+    def _choose_edge(self, graph, node, next_nodes, covered):
+        """
+        return (data, next node) of a edge from node, prefer the edge which
+        is not covered
+        """
+        choices = []
+        for next_node in next_nodes:
+            for data in sorted(graph[node][next_node], key=self._data_key):
+                choices.append(((node, data, next_node) in covered, data, next_node))
+        if choices:
+            _, data, next_node = min(choices, key=lambda x: x[0])
+            return data, next_node
+        return None, None
+
+    def _find_cover_route(self, graph, src_node, edge, tgt_node, dist, parents,
+                          covered, max_dep):
+        """
+        return the nodes of a route from src_node to tgt_node which pass
+        the edge and don't pass a node twice, or None
+        """
+        node, _, next_node = edge
+        # try the shortest way to the edge and go to the target by the
+        # edges which are not covered
+        nodes = [node]
+        while nodes[0] != src_node:
+            nodes.insert(0, parents[nodes[0]])
+        tmp_node = next_node
+        trace = set(nodes)
+        while tmp_node is not None and tmp_node not in trace and tgt_node not in trace:
+            nodes.append(tmp_node)
+            trace.add(tmp_node)
+            if tmp_node == tgt_node:
+                return nodes
+            _, tmp_node = self._choose_edge(
+                graph, tmp_node, [sub_node for sub_node in graph[tmp_node]
+                                  if dist.get(sub_node) == dist[tmp_node] - 1 and
+                                  sub_node not in trace], covered)
+
+        # search all the routes which pass the edge
+        if self._reverse_graph is None:
+            self._reverse_graph = reverse_graph(graph)
+        node_dist = target_distances(graph, node, self._reverse_graph, max_dep)
+        max_len = max_dep - 1 - dist[next_node]
+        for prefix in iter_simple_paths(graph, src_node, node, max_len, node_dist,
+                                        set([next_node, tgt_node])):
+            for suffix in iter_simple_paths(graph, next_node, tgt_node,
+                                            max_dep - len(prefix), dist, set(prefix)):
+                return prefix + suffix
+
+    def _data_key(self, data):
+        return data if self._use_map else get_func_name(data)
+
+    def gen_shortest_cases(self, test_func, max_cases=None, random_cleanup=False,
+                           need_cleanup=False, src_env=None):
+        """
+        Like gen_cases, but the cases are yielded from the shortest one and
+        stop after max_cases, only the cases which are used are computed.
+        The routes don't pass a env twice and have at most allow_dep steps.
+        """
+        if not self.dep_graph:
+            raise Exception('Need gen depend graph first')
+        src_env = EnvState.from_env(src_env) if src_env else EnvState.EMPTY
+        graph = self.id_graph if self._use_map else self.dep_graph
+        max_dep = self._allow_dep or len(graph)
+        src_node = self._graph_node(src_env)
+
+        targets = []
+        for tgt_env, new_tgt_env in self._find_test_envs(test_func):
+            tgt_node = self._graph_node(tgt_env)
+            dist = self._target_distances(tgt_node)
+            if src_node in dist:
+                targets.append([tgt_env, new_tgt_env, tgt_node, dist, None])
+
+        case_num = 0
+        for length in range(1, max_dep + 1):
+            for target in targets:
+                tgt_env, new_tgt_env, tgt_node, dist, cleanup_steps = target
+                for route in iter_routes_by_length(graph, src_node, tgt_node, length, dist):
+                    if need_cleanup and cleanup_steps is None and self._projector is None:
+                        cleanup_steps = target[4] = self.gen_cleanups(
+                            new_tgt_env, src_env, random_cleanup) or []
+                    for case in itertools.product(*route):
+                        case = self.restore_onigin_data(case)
+                        if self._use_por and not self._keep_order(src_env, tgt_env, case):
+                            continue
+                        if need_cleanup and self._projector is not None:
+                            cleanup_steps = self._projected_cleanups(
+                                src_env, case, test_func, random_cleanup) or []
+                        yield Case(case, tgt_env=self.restore_env(src_env, tgt_env, case),
+                                   cleanups=cleanup_steps)
+                        case_num += 1
+                        if max_cases and case_num >= max_cases:
+                            return
+
+    def gen_cleanups(self, src_env, tgt_env, random_cleanup=False):
+        """
+        return the cheapest steps from src_env to tgt_env, a random one of
+        them if random_cleanup
+        """
+        if not self.dep_graph:
+            raise Exception('Need gen depend graph first')
+        src_env = EnvState.from_env(src_env)
+        tgt_env = EnvState.from_env(tgt_env)
+        if self._projector is not None:
+            # the cleanups need the writes which the graph does not know
+            if self._cleanup_planner is None:
+                self._cleanup_planner = ConcreteCleanupPlanner(
+                    self._cleanup_funcs, self._cleanup_weight, self._drop_env)
+        else:
+            if self._cleanup_planner is None:
+                self._cleanup_planner = CleanupPlanner(self.dep_graph, self._cleanup_weight)
+            src_env = self._graph_state(src_env)
+            tgt_env = self._graph_state(tgt_env)
+        steps = self._cleanup_planner.plan(src_env, tgt_env,
+                                           random if random_cleanup else None)
+        if steps:
+            return steps
 
     def gen_cases_special(self, src_env, start_env, end_env):
         """
         Support find cases reach mutli target env
         """
         # TODO: this is tied to mist to close
+        src_env = EnvState.from_env(src_env)
         for tgt_start_env in self.find_suit_envs(start_env):
-            if tgt_start_env == src_env:
-                cases = None
-            else:
-                cases = self.compute_route_permutations(src_env, tgt_start_env)
-                if not cases:
-                    continue
+            need_route = tgt_start_env != self._graph_state(src_env)
             for tgt_end_env in self.dep_graph[tgt_start_env].keys():
-                if end_env <= tgt_end_env:
-                    funcs = self.dep_graph[tgt_start_env][tgt_end_env]
-                    if cases:
-                        for data in itertools.product(cases, funcs):
-                            case = list(data[0])
-                            case = self.restore_onigin_data(case)
-
-                            case.append(data[1])
-                            case_obj = Case(case, tgt_env=tgt_end_env)
-                            yield case_obj
-                    else:
-                        for func in funcs:
-                            case_obj = Case([func], tgt_env=tgt_end_env)
-                            yield case_obj
-
-    def gen_depend_map(self, test_funcs, drop_env=None, start_node=None):
-        dep_graph = {}
-        if not start_node:
-            start_node = Env()
-        dep_graph.setdefault(start_node, {})
-        nodes = [start_node]
-        widgets = ['Processed: ', Counter(), ' nodes (', Timer(), ')']
+                if not end_env <= tgt_end_env:
+                    continue
+                funcs = self.dep_graph[tgt_start_env][tgt_end_env]
+                if not need_route:
+                    for func in funcs:
+                        case_obj = Case([func], tgt_env=self.restore_env(src_env, tgt_end_env,
+                                                                         [func]))
+                        yield case_obj
+                    continue
+                # the routes are streamed, so enumerate them again for
+                # every end env
+                for route in self.iter_route_permutations(src_env, tgt_start_env):
+                    route = self.restore_onigin_data(list(route))
+                    for func in funcs:
+                        case = route + [func]
+                        case_obj = Case(case, tgt_env=self.restore_env(src_env, tgt_end_env,
+                                                                       case))
+                        yield case_obj
+
+    def gen_depend_map(self, test_funcs, drop_env=None, start_node=None, processes=None,
+                       targets=None, envs=None):
+        """
+        processes: expand the states on a process pool when more than 1
+        targets: only keep the env paths which the target functions, the
+        functions they depend on and the envs (like the mist areas) read,
+        the functions which cannot change them are left out and the states
+        which only differ in the other paths become one, the states are
+        expanded one by one then. The cleanups are planned from the envs
+        which the cases really reach
+        """
+        start_node = EnvState.from_env(start_node) if start_node else EnvState.EMPTY
+        test_funcs = list(test_funcs)
+        projector = None
+        cleanup_funcs = None
+        if targets is not None:
+            paths = set()
+            for env in envs or ():
+                for env_paths in env.require_paths():
+                    paths.update(env_paths)
+            num = len(test_funcs)
+            cleanup_funcs = slice_depends(targets, test_funcs, paths)[0]
+            test_funcs, paths = slice_depends(targets, test_funcs, paths, writes=False)
+            projector = EnvProjector(paths)
+            start_node = projector(start_node)
+            LOGGER.info('Project the states to %d paths, use %d of %d functions',
+                        len(paths), len(test_funcs), num)
+        context = None
+        if processes and processes > 1:
+            context = _get_fork_context()
+            if context is None:
+                LOGGER.warning('Cannot fork the workers, gen depend map in one process')
         LOGGER.info("Start gen depend map...")
+        if projector is not None:
+            dep_graph = self._expand_depend_map(start_node, test_funcs, projector.transfer,
+                                                len, drop_env)
+        elif context is not None:
+            dep_graph = self._expand_depend_map_parallel(start_node, test_funcs, drop_env,
+                                                         processes, self._use_bitset, context)
+        elif self._use_bitset:
+            engine = BitEnvEngine(test_funcs, [start_node])
+            mask_graph = self._expand_depend_map(engine.encode(start_node), test_funcs,
+                                                 engine.transfer, engine.size, drop_env)
+            dep_graph = {}
+            for node, data in mask_graph.items():
+                dep_graph[engine.decode(node)] = dict(
+                    (engine.decode(new_node), funcs) for new_node, funcs in data.items())
+        else:
+            dep_graph = self._expand_depend_map(start_node, test_funcs, self._transfer,
+                                                len, drop_env)
+
+        LOGGER.debug(pretty(dep_graph))
+        LOGGER.info('Depend map is %d x %d size',
+                    len(dep_graph), len(dep_graph))
+        LOGGER.info('Transition cache: %s', TRANSITION_CACHE)
+        self._set_dep_graph(dep_graph, test_funcs, drop_env, start_node, projector,
+                            cleanup_funcs)
+
+    def _set_dep_graph(self, dep_graph, test_funcs, drop_env=None, start_node=None,
+                       projector=None, cleanup_funcs=None):
+        self.dep_graph = dep_graph
+        self._suit_index = None
+        self._reverse_graph = None
+        self._distances = {}
+        self._counters = {}
+        self._components = None
+        self._cleanup_planner = None
+        self._state_map = None
+        self._projector = projector
+        self._cleanup_funcs = list(cleanup_funcs) if cleanup_funcs is not None else None
+        self._graph_funcs = list(test_funcs)
+        self._drop_env = drop_env
+        self._start_node = EnvState.from_env(start_node) if start_node else EnvState.EMPTY
+        self._graph_key = self.gen_graph_key(self._graph_funcs, drop_env, self._start_node)
+        if self._use_map:
+            self.build_graph_map()
+
+    def minimize_depend_map(self, test_funcs=None, envs=None):
+        """
+        Merge the states which have the same routes and cannot be told apart
+        by the test functions and the envs (like the mist areas), one of
+        the merged states stands for them in the graph. The tgt_env of the
+        cases are restored by replaying the steps.
+        test_funcs: the functions which will be tested, default all the
+        functions of the graph
+        """
+        if not self.dep_graph:
+            raise Exception('Need gen depend graph first')
+        if self._state_map is not None:
+            return
+        dep_graph = self.dep_graph
+        test_funcs = self._graph_funcs if test_funcs is None else list(test_funcs)
+        index = SubsumptionIndex(dep_graph)
+        marks = dict((node, set()) for node in dep_graph)
+        for i, func in enumerate(test_funcs):
+            for env in Env.gen_require_env(func):
+                for node in index.find(env):
+                    if node.gen_transfer_env(func) is not None:
+                        marks[node].add(('func', i))
+        for i, env in enumerate(envs or ()):
+            for node in index.find(env):
+                marks[node].add(('env', i))
+        start_node = self._start_node
+        blocks = partition_graph(dep_graph,
+                                 lambda node: (node == start_node, frozenset(marks[node])))
+
+        reps = {}
+        for node in dep_graph:
+            reps.setdefault(blocks[node], node)
+        state_map = dict((node, reps[blocks[node]]) for node in dep_graph)
+        graph = {}
+        for node in reps.values():
+            data = graph[node] = {}
+            for tgt_node, funcs in dep_graph[node].items():
+                data.setdefault(state_map[tgt_node], set()).update(funcs)
+        LOGGER.info('Minimize depend map from %d to %d states', len(dep_graph), len(graph))
+        self._set_dep_graph(graph, self._graph_funcs, self._drop_env, self._start_node,
+                            self._projector, self._cleanup_funcs)
+        self._state_map = state_map
+
+    def add_test_funcs(self, test_funcs):
+        """
+        add the functions to the depend graph, only the states which the new
+        functions can be used on and the new states are expanded
+        """
+        if self.dep_graph is None:
+            raise Exception('Need gen depend graph first')
+        if self._state_map is not None or self._projector is not None:
+            raise Exception('Cannot change a minimized or projected depend graph')
+        new_funcs = [func for func in test_funcs if func not in self._graph_funcs]
+        if not new_funcs:
+            return
+        LOGGER.info('Add %d functions to depend map', len(new_funcs))
+        all_funcs = self._graph_funcs + new_funcs
+        dep_graph = self.dep_graph
+        nodes = []
+        for node in list(dep_graph):
+            nodes.extend(self._expand_node(dep_graph, node, new_funcs, self._transfer,
+                                           len, self._drop_env))
+        self._expand_depend_map(None, all_funcs, self._transfer, len,
+                                self._drop_env, dep_graph=dep_graph, nodes=nodes)
+        self._set_dep_graph(dep_graph, all_funcs, self._drop_env, self._start_node)
+
+    def remove_test_funcs(self, test_funcs):
+        """
+        remove the edges of the functions from the depend graph and drop
+        the states which cannot be reached from the start state any more
+        """
+        if self.dep_graph is None:
+            raise Exception('Need gen depend graph first')
+        if self._state_map is not None or self._projector is not None:
+            raise Exception('Cannot change a minimized or projected depend graph')
+        old_funcs = set(func for func in test_funcs if func in self._graph_funcs)
+        if not old_funcs:
+            return
+        LOGGER.info('Remove %d functions from depend map', len(old_funcs))
+        dep_graph = self.dep_graph
+        for data in dep_graph.values():
+            for tgt_node, funcs in list(data.items()):
+                funcs -= old_funcs
+                if not funcs:
+                    del data[tgt_node]
+
+        reached = set([self._start_node])
+        nodes = [self._start_node]
+        while nodes:
+            node = nodes.pop()
+            for tgt_node in dep_graph[node]:
+                if tgt_node not in reached:
+                    reached.add(tgt_node)
+                    nodes.append(tgt_node)
+        for node in list(dep_graph):
+            if node not in reached:
+                del dep_graph[node]
+        LOGGER.info('Depend map is %d x %d size', len(dep_graph), len(dep_graph))
+        funcs = [func for func in self._graph_funcs if func not in old_funcs]
+        self._set_dep_graph(dep_graph, funcs, self._drop_env, self._start_node)
+
+    @staticmethod
+    def _transfer(node, func):
+        return node.gen_transfer_env(func)
+
+    @staticmethod
+    def _expand_node(dep_graph, node, test_funcs, transfer, size, drop_env=None):
+        """
+        add the edges of the functions from the node, return the new nodes
+        """
+        new_nodes = []
+        for func in test_funcs:
+            new_node = transfer(node, func)
+            LOGGER.debug('posible New Node: %s func: %s', new_node, func)
+            if new_node is None:
+                continue
+            if drop_env and size(new_node) > drop_env:
+                continue
+            if new_node not in dep_graph:
+                LOGGER.debug('New Node: %s func: %s', new_node, func)
+                dep_graph.setdefault(new_node, {})
+                new_nodes.append(new_node)
+            data = dep_graph[node]
+            data.setdefault(new_node, set())
+            data[new_node].add(func)
+        return new_nodes
+
+    @classmethod
+    def _expand_depend_map(cls, start_node, test_funcs, transfer, size, drop_env=None,
+                           dep_graph=None, nodes=None):
+        if dep_graph is None:
+            dep_graph = {}
+            dep_graph.setdefault(start_node, {})
+            nodes = [start_node]
+        widgets = ['Processed: ', Counter(), ' nodes (', Timer(), ')']
         try:
             pbar = ProgressBar(widgets=widgets, max_value=100000)
         except TypeError:
@@ -147,57 +853,468 @@ class DependGraphCaseGenerator(object):
         while nodes:
             node = nodes.pop()
             LOGGER.debug('Start check node %s', node)
-            for func in test_funcs:
-                new_node = node.gen_transfer_env(func)
-                LOGGER.debug('posible New Node: %s func: %s', new_node, func)
-                if new_node is None:
-                    continue
-                if drop_env and len(new_node) > drop_env:
-                    continue
-                if new_node not in dep_graph.keys():
-                    LOGGER.debug('New Node: %s func: %s', new_node, func)
-                    dep_graph.setdefault(new_node, {})
-                    nodes.append(new_node)
-                data = dep_graph[node]
-                data.setdefault(new_node, set())
-                data[new_node].add(func)
+            nodes.extend(cls._expand_node(dep_graph, node, test_funcs, transfer, size, drop_env))
             pbar.update(len(dep_graph))
+        return dep_graph
 
-        LOGGER.debug(pretty(dep_graph))
-        LOGGER.info('Depend map is %d x %d size',
-                    len(dep_graph), len(dep_graph))
-        self.dep_graph = dep_graph
-        if self._use_map:
-            self.build_graph_map()
+    @staticmethod
+    def _expand_depend_map_parallel(start_node, test_funcs, drop_env, processes,
+                                    use_bitset=False, context=None):
+        """
+        expand the graph level by level, the states of a level are sent to
+        the workers in batches and the results are merged in the order of
+        the batches, so the node order is the same for any processes
+        """
+        engine = BitEnvEngine(test_funcs, [start_node]) if use_bitset else None
+        if engine:
+            start = engine.encode(start_node)
+            decode = engine.decode
+        else:
+            start = tuple(sorted(start_node.set_paths()))
+            decode = EnvState.from_paths
+        # the workers get the functions by fork, they may not be picklable
+        context = context or _get_fork_context()
+        pool = context.Pool(processes, _init_expand_worker, (test_funcs, engine))
+        try:
+            graph = {start: {}}
+            frontier = [start]
+            while frontier:
+                batch_size = max(1, min(256, len(frontier) // (processes * 4)))
+                batches = [frontier[i:i + batch_size]
+                           for i in range(0, len(frontier), batch_size)]
+                results = pool.imap(_expand_worker, [(batch, drop_env) for batch in batches])
+                frontier = []
+                for batch, result in zip(batches, results):
+                    for node, edges in zip(batch, result):
+                        data = graph[node]
+                        for i, new_node in edges:
+                            if new_node not in graph:
+                                graph[new_node] = {}
+                                frontier.append(new_node)
+                            data.setdefault(new_node, set()).add(test_funcs[i])
+                LOGGER.info('Expanded %d nodes', len(graph))
+        finally:
+            pool.close()
+            pool.join()
+
+        states = dict((node, decode(node)) for node in graph)
+        dep_graph = {}
+        for node, data in graph.items():
+            dep_graph[states[node]] = dict(
+                (states[new_node], funcs) for new_node, funcs in data.items())
+        return dep_graph
 
     def build_graph_map(self):
         if not self.dep_graph:
             return
 
-        self._nodes_map = list(self.dep_graph.keys())
-        v_graph = {}
-
-        for node in self._nodes_map:
-            sub_map = {}
-            for tgt_node, datas in self.dep_graph[node].items():
-                tmp_datas = set()
-                for data in datas:
-                    if data not in self._edge_map:
-                        self._edge_map.append(data)
-                    tmp_datas.add(self._edge_map.index(data))
-                sub_map[self._nodes_map.index(tgt_node)] = tmp_datas
-            v_graph[self._nodes_map.index(node)] = sub_map
-
-        self._v_graph = v_graph
+        self.id_graph = IdGraph(self.dep_graph)
 
     def restore_onigin_data(self, datas):
         if self._use_map:
-            return [self._edge_map[data] for data in datas]
+            return self.id_graph.restore_edges(datas)
         else:
             return datas
 
+    @staticmethod
+    def gen_graph_key(test_funcs, drop_env=None, start_node=None):
+        """
+        return the content hash of the things which decide the depend graph
+        """
+        start_node = EnvState.from_env(start_node) if start_node else EnvState.EMPTY
+        signatures = sorted(get_func_signature(func) for func in test_funcs)
+        data = repr((GRAPH_CACHE_VERSION, drop_env, start_node.struct_table(), signatures))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _get_cache_file(path, key):
+        path = path or GRAPH_CACHE_DIR
+        if os.path.isdir(path) or not os.path.splitext(path)[1]:
+            return os.path.join(path, 'dep_graph-%s.cache' % key)
+        return path
+
     def save_dep_graph(self, path=None):
-        raise NotImplementedError
+        """
+        save the depend graph to a file, if path is a folder, the file
+        name is decided by the graph key
+        """
+        if not self.dep_graph or not self._graph_key:
+            raise Exception('Need gen depend graph first')
+        func_names = [get_func_name(func) for func in self._graph_funcs]
+        if len(set(func_names)) != len(func_names):
+            LOGGER.info('Cannot save depend graph, function names are not unique')
+            return
+        if self._state_map is not None or self._projector is not None:
+            LOGGER.info('Cannot save depend graph, it is minimized or projected')
+            return
+
+        paths = {}
+        nodes = {}
+        node_list = []
+        for node in self.dep_graph:
+            nodes[node] = len(node_list)
+            node_paths = []
+            for node_path in sorted(node.set_paths()):
+                node_paths.append(paths.setdefault('.'.join(node_path), len(paths)))
+            node_list.append(node_paths)
+        func_ids = dict((func, i) for i, func in enumerate(self._graph_funcs))
+        edges = []
+        for node, datas in self.dep_graph.items():
+            for tgt_node, funcs in datas.items():
+                edges.append([nodes[node], nodes[tgt_node],
+                              sorted(func_ids[func] for func in funcs)])
+
+        data = {'version': GRAPH_CACHE_VERSION,
+                'key': self._graph_key,
+                'funcs': func_names,
+                'paths': [path_str for path_str, _ in sorted(paths.items(), key=lambda x: x[1])],
+                'nodes': node_list,
+                'edges': edges}
+        cache_file = self._get_cache_file(path, self._graph_key)
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as fp:
+            fp.write(zlib.compress(json.dumps(data).encode('utf-8')))
+        os.rename(tmp_file, cache_file)
+        LOGGER.info('Save depend graph to %s', cache_file)
+        return cache_file
+
+    def load_dep_graph(self, path=None, test_funcs=None, drop_env=None, start_node=None):
+        """
+        load the depend graph which is generated by the same test functions
+        and options, return True if success
+        """
+        if test_funcs is None:
+            raise Exception('Need test functions to load depend graph')
+        test_funcs = list(test_funcs)
+        key = self.gen_graph_key(test_funcs, drop_env, start_node)
+        cache_file = self._get_cache_file(path, key)
+        if not os.path.isfile(cache_file):
+            return False
+        try:
+            with open(cache_file, 'rb') as fp:
+                data = json.loads(zlib.decompress(fp.read()).decode('utf-8'))
+        except (IOError, ValueError, zlib.error) as e:
+            LOGGER.info('Cannot read depend graph cache %s: %s', cache_file, e)
+            return False
+        if data.get('version') != GRAPH_CACHE_VERSION or data.get('key') != key:
+            LOGGER.info('Depend graph cache %s is out of date', cache_file)
+            return False
+
+        func_map = dict((get_func_name(func), func) for func in test_funcs)
+        funcs = [func_map[name] for name in data['funcs']]
+        paths = [compile_path(path_str) for path_str in data['paths']]
+        nodes = [EnvState.from_paths(paths[i] for i in node_paths)
+                 for node_paths in data['nodes']]
+        dep_graph = dict((node, {}) for node in nodes)
+        for src, tgt, func_ids in data['edges']:
+            dep_graph[nodes[src]][nodes[tgt]] = set(funcs[i] for i in func_ids)
+
+        self._set_dep_graph(dep_graph, test_funcs, drop_env, start_node)
+        LOGGER.info('Load depend graph from %s', cache_file)
+        return True
+
+
+class SubsumptionIndex(object):
+    """
+    Posting lists of the set paths of the states, help to find all the
+    states which include a partial env without checking every state
+    """
+    def __init__(self, states=None):
+        self._postings = {}
+        self._order = {}
+        for state in states or ():
+            self.add(state)
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, state):
+        if state in self._order:
+            return
+        self._order[state] = len(self._order)
+        for path in state.set_paths():
+            self._postings.setdefault(path, set()).add(state)
+
+    def find(self, env):
+        """
+        return the states which include the env, sorted by size
+        """
+        must_set, must_not_set = env.require_paths()
+        if must_set:
+            postings = sorted((self._postings.get(path, frozenset()) for path in must_set), key=len)
+            result = set(postings[0])
+            for posting in postings[1:]:
+                result &= posting
+        else:
+            result = set(self._order)
+        for path in must_not_set:
+            result -= self._postings.get(path, frozenset())
+        return sorted(result, key=lambda state: (len(state), self._order[state]))
+
 
-    def load_dep_graph(self, path=None):
-        raise NotImplementedError
+class NWiseCaseSelector(object):
+    """
+    Select the cases from a case stream until every ordered combination
+    of n steps in the stream is in a selected case, only the combinations
+    are kept in memory
+    """
+    def __init__(self, n=2):
+        if n < 1:
+            raise ValueError('n should be a positive number')
+        self.n = n
+        self._covered = set()
+
+    def __len__(self):
+        return len(self._covered)
+
+    def combinations(self, case):
+        """
+        return the ordered step combinations of the case, a case which is
+        shorter than n has only one combination of all its steps
+        """
+        steps = tuple(case.steps)
+        return set(itertools.combinations(steps, min(self.n, len(steps))))
+
+    def add(self, case):
+        """
+        return True and cover the combinations of the case if it has a new one
+        """
+        new_combinations = self.combinations(case) - self._covered
+        if new_combinations:
+            self._covered |= new_combinations
+            return True
+        return False
+
+    def select(self, cases):
+        for case in cases:
+            if self.add(case):
+                yield case
+
+
+class PartialOrderReducer(object):
+    """
+    Find the normal order of the steps, two orders of the same steps are
+    equivalent if they only differ in the order of independent steps. Two
+    steps are independent when none of them write a env path which the
+    other one read or write.
+    """
+    def __init__(self):
+        self._paths = {}
+        self._independent = {}
+
+    def _get_paths(self, func):
+        paths = self._paths.get(func)
+        if paths is None:
+            paths = self._paths[func] = get_func_paths(func)
+        return paths
+
+    @staticmethod
+    def _conflict(paths1, paths2):
+        for path1 in paths1:
+            for path2 in paths2:
+                if path1[:len(path2)] == path2 or path2[:len(path1)] == path1:
+                    return True
+        return False
+
+    def independent(self, func1, func2):
+        key = (func1, func2)
+        ret = self._independent.get(key)
+        if ret is None:
+            reads1, writes1 = self._get_paths(func1)
+            reads2, writes2 = self._get_paths(func2)
+            ret = func1 is not func2 and not (
+                self._conflict(writes1, reads2 | writes2) or
+                self._conflict(writes2, reads1))
+            self._independent[key] = self._independent[(func2, func1)] = ret
+        return ret
+
+    def normal_form(self, steps):
+        """
+        return the lexicographic smallest order of the steps by the
+        function names
+        """
+        steps = list(steps)
+        ret = []
+        while steps:
+            best = None
+            for i, step in enumerate(steps):
+                if best is not None and get_func_name(step) >= get_func_name(steps[best]):
+                    continue
+                # the step can be moved to the front
+                if all(self.independent(prev_step, step) for prev_step in steps[:i]):
+                    best = i
+            ret.append(steps.pop(best))
+        return ret
+
+
+class EnvProjector(object):
+    """
+    Drop the set paths of the states which are not under the given paths,
+    the paths must include the reads of the functions in the graph
+    """
+    def __init__(self, paths):
+        self._paths = frozenset(paths)
+        self._states = {}
+
+    def _keep(self, path):
+        for i in range(1, len(path) + 1):
+            if path[:i] in self._paths:
+                return True
+        return False
+
+    def __call__(self, state):
+        new_state = self._states.get(state)
+        if new_state is None:
+            new_state = EnvState.from_paths(path for path in state.set_paths()
+                                            if self._keep(path))
+            self._states[state] = self._states[new_state] = new_state
+        return new_state
+
+    def transfer(self, state, func):
+        new_state = state.gen_transfer_env(func)
+        if new_state is not None:
+            return self(new_state)
+
+
+class CleanupPlanner(object):
+    """
+    Find the cheapest steps from a env to a clean env, one Dijkstra on the
+    reversed depend graph for every clean env, the results are cached
+    """
+    def __init__(self, dep_graph, weight=None):
+        self._graph = dep_graph
+        # the weight should be positive
+        self._weight = weight or (lambda func: 1)
+        self._reverse = None
+        self._costs = {}
+        self._steps = {}
+
+    def _reverse_graph(self):
+        if self._reverse is None:
+            self._reverse = dict((node, []) for node in self._graph)
+            for node, datas in self._graph.items():
+                for tgt_node, funcs in datas.items():
+                    cost = min(self._weight(func) for func in funcs)
+                    self._reverse[tgt_node].append((node, cost))
+        return self._reverse
+
+    def costs(self, tgt_env):
+        """
+        return {env: the cost of the cheapest steps from env to tgt_env}
+        """
+        costs = self._costs.get(tgt_env)
+        if costs is not None:
+            return costs
+        reverse = self._reverse_graph()
+        costs = {tgt_env: 0}
+        heap = [(0, 0, tgt_env)]
+        index = 1
+        while heap:
+            cost, _, node = heapq.heappop(heap)
+            if cost > costs[node]:
+                continue
+            for src_node, edge_cost in reverse.get(node, ()):
+                new_cost = cost + edge_cost
+                if src_node not in costs or new_cost < costs[src_node]:
+                    costs[src_node] = new_cost
+                    heapq.heappush(heap, (new_cost, index, src_node))
+                    index += 1
+        self._costs[tgt_env] = costs
+        return costs
+
+    def plan(self, src_env, tgt_env, rand=None):
+        """
+        return the functions of the cheapest steps or None if tgt_env cannot
+        be reached, rand is a random.Random like object to choose one of the
+        cheapest steps randomly
+        """
+        if rand is None and (src_env, tgt_env) in self._steps:
+            return list(self._steps[(src_env, tgt_env)])
+        costs = self.costs(tgt_env)
+        if src_env not in costs:
+            return
+        steps = []
+        node = src_env
+        while node != tgt_env:
+            choices = []
+            for next_node, funcs in self._graph[node].items():
+                if next_node not in costs:
+                    continue
+                for func in funcs:
+                    if abs(self._weight(func) + costs[next_node] - costs[node]) < 1e-9:
+                        choices.append((get_func_name(func), func, next_node))
+            if rand is None:
+                _, func, node = min(choices, key=lambda x: x[0])
+            else:
+                _, func, node = rand.choice(sorted(choices, key=lambda x: x[0]))
+            steps.append(func)
+        if rand is None:
+            self._steps[(src_env, tgt_env)] = steps
+        return list(steps)
+
+
+class ConcreteCleanupPlanner(object):
+    """
+    Find the cheapest steps between the concrete envs of a projected depend
+    graph, the envs are expanded from src_env with the functions by Dijkstra
+    until tgt_env is found, then CleanupPlanner chooses the steps on the
+    expanded envs. The expanded envs and the results are cached
+    """
+    def __init__(self, funcs, weight=None, drop_env=None):
+        self._funcs = list(funcs)
+        # the weight should be positive
+        self._weight = weight or (lambda func: 1)
+        self._drop_env = drop_env
+        self._graph = {}
+        self._steps = {}
+
+    def _expand(self, node):
+        data = self._graph.get(node)
+        if data is None:
+            data = self._graph[node] = {}
+            for func in self._funcs:
+                new_node = node.gen_transfer_env(func)
+                if new_node is not None:
+                    data.setdefault(new_node, set()).add(func)
+        return data
+
+    def plan(self, src_env, tgt_env, rand=None):
+        """
+        same as CleanupPlanner.plan
+        """
+        if rand is None and (src_env, tgt_env) in self._steps:
+            return list(self._steps[(src_env, tgt_env)])
+        # the envs on the way can be as large as src_env
+        max_size = max(self._drop_env, len(src_env)) if self._drop_env else None
+        graph = {}
+        costs = {src_env: 0}
+        heap = [(0, 0, src_env)]
+        index = 1
+        while heap:
+            cost, _, node = heapq.heappop(heap)
+            if cost > costs[node]:
+                continue
+            if node == tgt_env:
+                break
+            data = graph[node] = {}
+            for new_node, funcs in self._expand(node).items():
+                if max_size and len(new_node) > max_size:
+                    continue
+                data[new_node] = funcs
+                new_cost = cost + min(self._weight(func) for func in funcs)
+                if new_node not in costs or new_cost < costs[new_node]:
+                    costs[new_node] = new_cost
+                    heapq.heappush(heap, (new_cost, index, new_node))
+                    index += 1
+        else:
+            return
+        # the cheapest steps only pass the expanded envs
+        for node in costs:
+            graph.setdefault(node, {})
+        steps = CleanupPlanner(graph, self._weight).plan(src_env, tgt_env, rand)
+        if rand is None:
+            self._steps[(src_env, tgt_env)] = steps
+        return list(steps)
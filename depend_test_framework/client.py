@@ -37,6 +37,18 @@ def load_template(template_file):
             mist_rules: 'split'
             max_cases: 30
             drop_env: 3
+            graph_cache: True // optional, cache the depend graph in a folder
+            graph_processes: 8 // optional, gen the depend graph on a process pool
+            minimize_graph: True // optional, merge the states which the tests cannot tell apart
+            slice_graph: True // optional, gen a depend graph for every test with the functions it depends on
+            project_graph: True // optional, only keep the env paths which the tests and the mists read,
+                                 // graph_cache and graph_processes are not used then
+            sample_cases: 30 // optional, run 30 random cases instead of the shortest ones
+            seed: 1 // optional, random seed of sample_cases
+            case_select: cover // optional, 'cover' only run the cases which cover all the steps,
+                               // 'nwise' only run the cases which cover all the n steps combinations
+                               // max_cases is not used with 'cover' and 'nwise'
+            nwise: 2 // optional, n of case_select nwise
         
         case: // required, this part for test case generate
              - name: test cases name
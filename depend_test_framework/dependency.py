@@ -2,6 +2,7 @@
 Classes that help to identify the dependency between test objects
 """
 import copy
+import sys
 
 from .base_class import Entrypoint, check_func_entrys, get_entrypoint
 
@@ -10,14 +11,61 @@ from .log import get_logger
 LOGGER = get_logger(__name__)
 
 
+def _intern(segment):
+    try:
+        return sys.intern(segment)
+    except AttributeError:
+        # python2
+        try:
+            return intern(segment)
+        except TypeError:
+            return segment
+    except TypeError:
+        return segment
+
+
+class PathRegistry(object):
+    """
+    Compile the env path strings into tuples of interned segments, every
+    path is only split once and the same path always get the same tuple
+    """
+    def __init__(self):
+        self._paths = {}
+
+    def __len__(self):
+        return len(self._paths)
+
+    def compile(self, path):
+        ret = self._paths.get(path)
+        if ret is None:
+            if isinstance(path, tuple):
+                ret = tuple(_intern(segment) for segment in path)
+            else:
+                ret = tuple(_intern(segment) for segment in path.split('.')) if path else ()
+            ret = self._paths.setdefault(ret, ret)
+            self._paths[path] = ret
+        return ret
+
+
+PATH_REGISTRY = PathRegistry()
+
+
+def compile_path(path):
+    return PATH_REGISTRY.compile(path)
+
+
 class Dependency(Entrypoint):
     def __init__(self, env_depend, depend_type):
         self.env_depend = env_depend
         self.depend_list = env_depend.split('.')
         self.type = depend_type
+        # compiled paths of the '|' alternatives
+        self.alternatives = tuple(compile_path(path) for path in env_depend.split('|'))
+        self.path = self.alternatives[0]
+        self._hash = hash((self.env_depend, self.type))
 
     def __hash__(self):
-        return hash("%s|%s" % (self.env_depend, self.type))
+        return self._hash
 
     def __eq__(self, target):
         if not isinstance(target, Dependency):
@@ -42,11 +90,13 @@ class Graft(Entrypoint):
     def __init__(self, src, tgt):
         self.src = src
         self.tgt = tgt
+        self.src_path = compile_path(src)
+        self.tgt_path = compile_path(tgt)
 
     def effect_env(self, env):
-        sub_env = env.get_data(self.src)
+        sub_env = env.get_data(self.src_path)
         new_env = copy.deepcopy(sub_env)
-        env.set_data(self.tgt, new_env)
+        env.set_data(self.tgt_path, new_env)
         if not new_env.data:
             new_env.data = True
 
@@ -62,9 +112,10 @@ class Cut(Entrypoint):
     """
     def __init__(self, src):
         self.src = src
+        self.src_path = compile_path(src)
 
     def effect_env(self, env):
-        sub_env = env.get_data(self.src)
+        sub_env = env.get_data(self.src_path)
         sub_env.childs = {}
         sub_env.data = False
 
@@ -74,9 +125,9 @@ class Migrate(Graft):
     TODO
     """
     def effect_env(self, env):
-        sub_env = env.get_data(self.src)
+        sub_env = env.get_data(self.src_path)
         new_env = copy.deepcopy(sub_env)
-        env.set_data(self.tgt, new_env)
+        env.set_data(self.tgt_path, new_env)
         if not new_env.data:
             new_env.data = True
         sub_env.childs = {}
@@ -103,7 +154,7 @@ class Provider(Dependency):
         elif self.type == self.CLEAR:
             need_set = False
 
-        env.set_data(self.env_depend, need_set)
+        env.set_data(self.path, need_set)
 
 
 class Consumer(Dependency):
@@ -162,3 +213,115 @@ def get_all_depend(func, depend_types=None,
                 else:
                     depends.setdefault(entry.env_depend, []).append(entry)
     return depends
+
+
+def get_func_paths(func):
+    """
+    return (read paths, write paths) of the env which the function use
+    """
+    reads = set()
+    writes = set()
+    for dep in get_all_depend(func, depend_cls=Consumer):
+        reads.update(dep.alternatives)
+    for dep in get_all_depend(func, depend_cls=Provider):
+        writes.add(dep.path)
+    for obj in get_all_depend(func, depend_cls=Graft):
+        reads.add(obj.src_path)
+        writes.add(obj.tgt_path)
+        if isinstance(obj, Migrate):
+            writes.add(obj.src_path)
+    for obj in get_all_depend(func, depend_cls=Cut):
+        writes.add(obj.src_path)
+    return frozenset(reads), frozenset(writes)
+
+
+def _paths_conflict(path1, path2):
+    return path1[:len(path2)] == path2 or path2[:len(path1)] == path1
+
+
+def _func_affects(func, path):
+    """
+    return True if the function may change whether path or any path
+    under it is set, which is what a Consumer of path checks
+    """
+    requires = [con.alternatives for con in get_all_depend(func, depend_cls=Consumer)
+                if con.type == Consumer.REQUIRE]
+    for obj in get_all_depend(func, depend_cls=(Provider, Graft, Cut)):
+        if isinstance(obj, Provider):
+            if obj.path[:len(path)] != path:
+                continue
+            # set a path under path which is required to be set already
+            if obj.type == Provider.SET and obj.path != path and \
+                    any(all(alt[:len(path)] == path for alt in alts) for alts in requires):
+                continue
+            return True
+        elif isinstance(obj, Graft):
+            if _paths_conflict(obj.tgt_path, path):
+                return True
+            if isinstance(obj, Migrate) and _paths_conflict(obj.src_path, path):
+                return True
+        elif _paths_conflict(obj.src_path, path):
+            return True
+    return False
+
+
+def _func_requires(func, paths):
+    """
+    return the paths which decide if the function can be used and what
+    it writes to the paths
+    """
+    requires = set()
+    for con in get_all_depend(func, depend_cls=Consumer):
+        requires.update(con.alternatives)
+    for obj in get_all_depend(func, depend_cls=Graft):
+        src, tgt = obj.src_path, obj.tgt_path
+        for path in paths:
+            if path[:len(tgt)] == tgt:
+                requires.add(src + path[len(tgt):])
+            elif tgt[:len(path)] == path:
+                requires.add(src)
+    return requires
+
+
+def slice_depends(targets, funcs, paths=(), writes=True):
+    """
+    return (functions, env paths), the functions of funcs which may change
+    the env paths that the targets read or write or that are in paths,
+    and all the paths which the returned functions require or write in
+    turn. The functions which clear the writes are kept for the cleanups.
+    The other functions and paths cannot change a route to the targets
+    or back, so they can be left out of the depend graph
+    writes: if False, only follow the paths which are read, the functions
+    which clear the other writes are left out too
+    """
+    paths = set(paths)
+    for func in targets:
+        reads, func_writes = get_func_paths(func)
+        paths.update(reads)
+        if writes:
+            paths.update(func_writes)
+    funcs = list(funcs)
+    chosen = set()
+    changed = True
+    while changed:
+        changed = False
+        for func in funcs:
+            if func not in chosen:
+                if not any(_func_affects(func, path) for path in paths):
+                    continue
+                chosen.add(func)
+            new_paths = _func_requires(func, paths)
+            if writes:
+                new_paths |= get_func_paths(func)[1]
+            new_paths -= paths
+            if new_paths:
+                paths.update(new_paths)
+                changed = True
+    return [func for func in funcs if func in chosen], frozenset(paths)
+
+
+def slice_funcs(targets, funcs, paths=()):
+    """
+    return the functions of slice_depends
+    """
+    return slice_depends(targets, funcs, paths)[0]
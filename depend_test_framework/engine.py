@@ -8,12 +8,14 @@ import contextlib
 from .base_class import Container, Params, get_func_params_require
 from .test_object import is_TestObject, is_Action, is_CheckPoint, is_Hybrid, StaticMist
 from .dependency import is_Graft, get_all_depend, Provider, Consumer, Graft, is_ExtraDepend
+from .dependency import slice_funcs
 from .log import get_logger, get_file_logger, make_timing_logger
 from .case_generator import DependGraphCaseGenerator
 from .runner_handlers import MistsHandler
 from .runners import Runner
 from .learning import StepsSeqScorer
 from .hook import EnvHook, CaseHook
+from .env import TRANSITION_CACHE
 
 LOGGER = get_logger(__name__)
 time_log = make_timing_logger(LOGGER)
@@ -79,6 +81,8 @@ class BaseEngine(object):
                 if getattr(module, name, None):
                     self.doc_funcs[name] = getattr(module, name)
                     break
+        # the depends of the functions may be changed by the extra depends
+        TRANSITION_CACHE.clear()
 
         if self.hook_module:
             for _, obj in inspect.getmembers(self.hook_module,
@@ -211,21 +215,40 @@ class Demo(BaseEngine):
         extra_handler = self._load_extra_handler(runner)
 
         # generate test case
-        with time_log('Compute case permutations'):
-            # TODO: is that a good idea to use handler to gen case ?
-            case_matrix = sorted(list(extra_handler.gen_cases(test_func, need_cleanup=need_cleanup)))
-
-        LOGGER.info('Find %d valid cases', len(case_matrix))
-
         if self.params.ai_test:
+            with time_log('Compute case permutations'):
+                # TODO: is that a good idea to use handler to gen case ?
+                case_matrix = sorted(extra_handler.gen_cases(test_func, need_cleanup=need_cleanup))
+            LOGGER.info('Find %d valid cases', len(case_matrix))
             # training part
             self._training(case_matrix, test_func)
             return
 
+        if self.params.case_select == 'cover':
+            # the cases only cover all the steps together, so run them all
+            if max_cases:
+                LOGGER.warning('max_cases is not used with case_select cover')
+                max_cases = None
+            case_matrix = extra_handler.gen_cover_cases(test_func, need_cleanup=need_cleanup)
+        elif self.params.case_select == 'nwise':
+            # the same for the n steps combinations
+            if max_cases:
+                LOGGER.warning('max_cases is not used with case_select nwise')
+                max_cases = None
+            case_matrix = extra_handler.gen_nwise_cases(test_func, self.params.nwise or 2,
+                                                        need_cleanup=need_cleanup)
+        elif self.params.sample_cases:
+            case_matrix = extra_handler.gen_sample_cases(test_func, self.params.sample_cases,
+                                                         seed=self.params.seed,
+                                                         need_cleanup=need_cleanup)
+        else:
+            # the cases are generated from the shortest one when they are used
+            case_matrix = extra_handler.gen_shortest_cases(test_func, need_cleanup=need_cleanup,
+                                                           max_cases=max_cases)
+
         # TODO use a class to be a cases container
         extra_cases = {}
-        while case_matrix:
-            case = case_matrix.pop(0)
+        for case in case_matrix:
             new_extra_cases, is_mist = runner.run_case(case, case_index, test_func,
                                                        need_cleanup, only_doc=only_doc)
             if not full_matrix and not is_mist:
@@ -301,8 +324,65 @@ class Demo(BaseEngine):
 
     def prepare(self):
         self.filter_all_func_custom(self._cb_filter_with_param)
+        if not self.params.slice_graph:
+            tests = [func for func in self._prepare_test_funcs()
+                     if not StaticMist.issubclass(func)]
+            self._prepare_graph(self.actions | self.hybrids, tests)
+
+    def _slice_funcs(self, test_func):
+        """
+        return the functions which can change the env of the test_func
+        """
+        funcs = self.actions | self.hybrids
+        if isinstance(test_func, StaticMist):
+            return funcs
+        # keep the functions which reach or leave the mist areas too
+        paths = set()
+        for env in self._mist_envs():
+            for env_paths in env.require_paths():
+                paths.update(env_paths)
+        sliced_funcs = slice_funcs([test_func], funcs, paths)
+        LOGGER.info('Use %d of %d functions for %s', len(sliced_funcs), len(funcs),
+                    self._get_func_name(test_func))
+        return sliced_funcs
+
+    def _mist_envs(self):
+        envs = []
+        for mist in self.static_mists:
+            for start_env, end_env in mist._areas.values():
+                envs.extend((start_env, end_env))
+        return envs
+
+    def _prepare_graph(self, test_funcs, tests):
+        envs = self._mist_envs()
+        if self.params.project_graph:
+            if self.params.graph_cache or self.params.graph_processes:
+                LOGGER.warning('graph_cache and graph_processes are not used with '
+                               'project_graph, the projected depend map is not cached '
+                               'and is generated in one process')
+            with time_log('Gen the projected depend map'):
+                self.case_gen.gen_depend_map(test_funcs, self.params.drop_env,
+                                             targets=tests, envs=envs)
+        else:
+            self._load_or_gen_graph(test_funcs)
+        if self.params.minimize_graph:
+            with time_log('Minimize the depend map'):
+                self.case_gen.minimize_depend_map(tests, envs)
+
+    def _load_or_gen_graph(self, test_funcs):
+        # graph_cache can be True or the folder of the cache files
+        cache_path = self.params.graph_cache
+        if cache_path is True:
+            cache_path = None
+        if self.params.graph_cache:
+            with time_log('Load the depend map'):
+                if self.case_gen.load_dep_graph(cache_path, test_funcs, self.params.drop_env):
+                    return
         with time_log('Gen the depend map'):
-            self.case_gen.gen_depend_map(self.actions | self.hybrids, self.params.drop_env)
+            self.case_gen.gen_depend_map(test_funcs, self.params.drop_env,
+                                         processes=self.params.graph_processes)
+        if self.params.graph_cache:
+            self.case_gen.save_dep_graph(cache_path)
 
     def run(self, params, doc_file=None):
         self.params = params
@@ -322,6 +402,8 @@ class Demo(BaseEngine):
                 # FIXME: remove this
                 if StaticMist.issubclass(test_func):
                     test_func = test_func()
+                if self.params.slice_graph:
+                    self._prepare_graph(self._slice_funcs(test_func), [test_func])
 
                 try:
                     self._start_test(test_func,
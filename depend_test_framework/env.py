@@ -1,40 +1,75 @@
 """
 A class help to create and manage a virtual test env
 """
+import collections
 import contextlib
 import copy
 import itertools
+import weakref
 
 from .log import get_logger
-from .dependency import Consumer, Provider, Cut, Graft, get_all_depend
+from .dependency import Consumer, Provider, Cut, Graft, get_all_depend, compile_path
 
 LOGGER = get_logger(__name__)
 
+# the truth value of these data cannot be changed in place
+try:
+    IMMUTABLE_DATA = (type(None), bool, int, long, float, str, unicode, tuple, frozenset)
+except NameError:
+    IMMUTABLE_DATA = (type(None), bool, int, float, str, bytes, tuple, frozenset)
+
 
 class Env(object):
     """
     TODO
     """
     def __init__(self, data=None, parent=None, childs=None, path=''):
-        self.data = data
+        # cached EnvState, reset when this env or its childs changed
+        self._state = None
         self.parent = parent
+        self.data = data
         self.childs = childs if childs else {}
         self._path = path
 
         self._record = False
         self._history = []
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._invalidate()
+
+    @property
+    def childs(self):
+        return self._childs
+
+    @childs.setter
+    def childs(self, value):
+        self._childs = value
+        self._invalidate()
+
+    def _invalidate(self):
+        env = self
+        while env is not None:
+            env._state = None
+            env = env.parent
+
     def __getitem__(self, key):
-        value = self.childs.get(key)
+        value = self._childs.get(key)
         if value is None and not key.startswith("_"):
             value = child_env = self.__class__(parent=self, path=key)
-            self.childs[key] = child_env
+            self._childs[key] = child_env
         return value
 
     def __setitem__(self, key, value):
         if isinstance(value, self.__class__):
-            self.childs[key] = value
+            self._childs[key] = value
             value.parent = self
+            self._invalidate()
         else:
             child_env = self[key]
             child_env.data = value
@@ -68,9 +103,8 @@ class Env(object):
     def _get_data_from_path(self, path, use_getitem=False):
         if not path:
             return self
-        split_path = path.split('.')
         tmp_env = self
-        for data in split_path:
+        for data in compile_path(path):
             if not isinstance(tmp_env, self.__class__):
                 return
             if use_getitem:
@@ -86,7 +120,8 @@ class Env(object):
         if env is None:
             raise Exception
         if isinstance(value, self.__class__):
-            env.childs = value.childs
+            # copy the sub tree, so value keeps its own childs and state
+            env.childs = copy.deepcopy(value.childs)
             env._change_parent(env)
             LOGGER.debug('Env %s update sub env: %s, value: %s', self, path, value)
             env.data = value.data
@@ -107,8 +142,7 @@ class Env(object):
             raise NotImplementedError
 
         # TODO: support more kind of operation
-        paths = depend.env_depend.split('|')
-        for path in paths:
+        for path in depend.alternatives:
             if self._valid_single_require(path, require):
                 return True
 
@@ -116,7 +150,7 @@ class Env(object):
 
     def _valid_single_require(self, path, require):
         ret = self._get_data_from_path(path)
-        if ret is not None and (ret.struct_table() != '{}' or ret.data):
+        if ret is not None and ret.need_fmt():
             return require
         else:
             return not require
@@ -136,12 +170,18 @@ class Env(object):
         """
         return transfered env Or Null if not suit
         """
-        con = get_all_depend(func, depend_cls=Consumer)
-        if not self.hit_requires(con):
+        state = self.freeze()
+        cached = TRANSITION_CACHE.get(state, func)
+        if cached is TRANSITION_CACHE.NOT_SUIT:
+            return
+        if cached is None and not state.hit_requires(get_all_depend(func, depend_cls=Consumer)):
+            TRANSITION_CACHE.add(state, func, None)
             return
         new_env = copy.deepcopy(self)
         objs = get_all_depend(func, depend_cls=(Provider, Graft, Cut))
         new_env.call_effect_env(objs)
+        if cached is None:
+            TRANSITION_CACHE.add(state, func, new_env.freeze())
         return new_env
 
     @classmethod
@@ -153,7 +193,7 @@ class Env(object):
         env_paths = []
         for con in cons:
             if con.type == Consumer.REQUIRE:
-                env_paths.append(con.env_depend.split('|'))
+                env_paths.append(con.alternatives)
         all_paths = itertools.product(*env_paths)
         for paths in all_paths:
             env = cls()
@@ -161,6 +201,15 @@ class Env(object):
                 env._set_data_from_path(path, True)
             yield env
 
+    def __deepcopy__(self, memo):
+        """
+        only copy the sub tree, the parent is not copied
+        """
+        new_env = self.__class__(copy.deepcopy(self.data, memo), path=self._path)
+        for key, value in self.childs.items():
+            new_env[key] = copy.deepcopy(value, memo)
+        return new_env
+
     def __reduce__(self):
         return self.__reduce_ex__(None)
 
@@ -171,43 +220,69 @@ class Env(object):
         """
         NOTICE: don't change the env if really use this
         """
-        return hash(self.struct_table())
+        return hash(self.freeze())
+
+    def freeze(self):
+        """
+        return the interned EnvState of this env, the result is cached
+        until this env or its childs changed
+        """
+        if self._state is not None:
+            return self._state
+        # the data can be changed in place, so cannot cache it
+        cacheable = isinstance(self._data, IMMUTABLE_DATA)
+        childs = []
+        for key, value in self._childs.items():
+            state = value.freeze()
+            if value._state is None:
+                cacheable = False
+            if state is not EnvState.EMPTY:
+                childs.append((key, state))
+        state = EnvState(bool(self._data), tuple(sorted(childs)))
+        if cacheable:
+            self._state = state
+        return state
 
     def struct_table(self):
-        if not self.keys():
-            # TODO
-            return '{}'
-        ret = '{'
-        for key, value in sorted(self.items()):
-            if value.need_fmt():
-                ret += ' %s|%s: %s,' % (key, bool(value.data), value.struct_table())
-        ret += '}'
-        return ret
+        return self.freeze().struct_table()
 
     def __cmp__(self, target):
+        if isinstance(target, (EnvState, PersistentEnv)):
+            return self.freeze() is target.freeze()
         if not isinstance(target, self.__class__):
             return False
-        return self.struct_table() == target.struct_table()
+        return self.freeze() is target.freeze()
 
     def __eq__(self, target):
         return self.__cmp__(target)
 
+    def __ne__(self, target):
+        return not self.__cmp__(target)
+
     def __len__(self):
-        num = 0
-        if self.values():
-            for child in self.values():
-                num += len(child)
-        elif self.data:
-            return 1
-        return num
+        return len(self.freeze())
 
     def need_fmt(self):
-        for child in self.values():
-            if child.need_fmt():
-                return True
-        if self.data:
-            return True
-        return False
+        return self.freeze() is not EnvState.EMPTY
+
+    def require_paths(self):
+        """
+        return (paths must be set, paths must not be set) when use this env
+        as a partial env in _check_include
+        """
+        must_set = []
+        must_not_set = []
+        stack = [((), self)]
+        while stack:
+            path, env = stack.pop()
+            for key, value in env.items():
+                sub_path = path + (key,)
+                if value.data:
+                    must_set.append(sub_path)
+                elif value.data is False:
+                    must_not_set.append(sub_path)
+                stack.append((sub_path, value))
+        return must_set, must_not_set
 
     def _full_path(self):
         if self.parent is not None and self.parent._full_path():
@@ -235,3 +310,424 @@ class Env(object):
             if not value._check_include(target[key]):
                 return False
         return True
+
+
+class EnvState(object):
+    """
+    Immutable snapshot of an Env, only the nodes which need to be formatted
+    are kept and data is reduced to a bool. States are interned, so the Envs
+    which have the same struct_table() share one EnvState object and can be
+    compared by identity.
+    """
+    __slots__ = ('data', '_childs', '_child_map', '_hash', '_len', '_set_paths', '__weakref__')
+    _pool = weakref.WeakValueDictionary()
+    EMPTY = None
+
+    def __new__(cls, data=False, childs=()):
+        key = (data, childs)
+        inst = cls._pool.get(key)
+        if inst is None:
+            inst = super(EnvState, cls).__new__(cls)
+            inst.data = data
+            inst._childs = childs
+            inst._child_map = dict(childs)
+            inst._hash = hash(key)
+            inst._len = None
+            inst._set_paths = None
+            cls._pool[key] = inst
+        return inst
+
+    @classmethod
+    def from_env(cls, env):
+        if isinstance(env, cls):
+            return env
+        return env.freeze()
+
+    @classmethod
+    def from_paths(cls, paths):
+        """
+        return the state which only have the data of the paths set
+        """
+        tree = {}
+        for path in paths:
+            node = [False, tree]
+            for key in path:
+                node = node[1].setdefault(key, [False, {}])
+            node[0] = True
+
+        def _build(data, childs):
+            return cls(data, tuple(sorted((key, _build(*value))
+                                          for key, value in childs.items())))
+
+        return _build(False, tree)
+
+    def to_env(self, env_cls=None, path=''):
+        """
+        return a new Env which have the same struct as this state
+        """
+        env = (env_cls or Env)(data=True if self.data else None, path=path)
+        for key, value in self._childs:
+            env[key] = value.to_env(env_cls, key)
+        return env
+
+    def freeze(self):
+        return self
+
+    def with_data(self, data):
+        return EnvState(bool(data), self._childs)
+
+    def with_child(self, key, child):
+        childs = dict(self._child_map)
+        if child is self.EMPTY:
+            childs.pop(key, None)
+        else:
+            childs[key] = child
+        return EnvState(self.data, tuple(sorted(childs.items())))
+
+    def update(self, path, func):
+        """
+        return a new state which the node in the path is replaced by
+        func(node), only the nodes on the path are rebuilt
+        """
+        if not path:
+            return func(self)
+        key = path[0]
+        return self.with_child(key, self[key].update(path[1:], func))
+
+    def keys(self):
+        return self._child_map.keys()
+
+    def values(self):
+        return self._child_map.values()
+
+    def items(self):
+        return self._childs
+
+    @property
+    def childs(self):
+        return self._child_map
+
+    def __getitem__(self, key):
+        return self._child_map.get(key, self.EMPTY)
+
+    def get_data(self, path):
+        if not path:
+            return self
+        tmp_state = self
+        for data in compile_path(path):
+            tmp_state = tmp_state._child_map.get(data)
+            if tmp_state is None:
+                return
+        return tmp_state
+
+    def hit_require(self, depend):
+        if depend.type == Consumer.REQUIRE:
+            require = True
+        elif depend.type == Consumer.REQUIRE_N:
+            require = False
+        else:
+            raise NotImplementedError
+
+        for path in depend.alternatives:
+            if self._valid_single_require(path, require):
+                return True
+
+        return False
+
+    def _valid_single_require(self, path, require):
+        ret = self.get_data(path)
+        if ret is not None and ret is not self.EMPTY:
+            return require
+        else:
+            return not require
+
+    def hit_requires(self, depends):
+        for depend in depends:
+            if not self.hit_require(depend):
+                return False
+
+        return True
+
+    def gen_transfer_env(self, func):
+        """
+        return transfered state Or Null if not suit
+        """
+        return TRANSITION_CACHE.transfer(self, func)
+
+    def _gen_transfer_env(self, func):
+        con = get_all_depend(func, depend_cls=Consumer)
+        if not self.hit_requires(con):
+            return
+        new_env = PersistentEnv(self)
+        objs = get_all_depend(func, depend_cls=(Provider, Graft, Cut))
+        new_env.call_effect_env(objs)
+        return new_env.freeze()
+
+    def struct_table(self):
+        if not self._childs:
+            return '{}'
+        ret = '{'
+        for key, value in self._childs:
+            ret += ' %s|%s: %s,' % (key, value.data, value.struct_table())
+        ret += '}'
+        return ret
+
+    def __str__(self):
+        return self.struct_table()
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.struct_table())
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, target):
+        if isinstance(target, (Env, PersistentEnv)):
+            return self is target.freeze()
+        return self is target
+
+    def __ne__(self, target):
+        return not self.__eq__(target)
+
+    def __len__(self):
+        if self._len is None:
+            if self._childs:
+                self._len = sum(len(value) for _, value in self._childs)
+            else:
+                self._len = 1 if self.data else 0
+        return self._len
+
+    def set_paths(self):
+        """
+        return the paths of the nodes which data is set
+        """
+        if self._set_paths is None:
+            paths = []
+            for key, value in self._childs:
+                if value.data:
+                    paths.append((key,))
+                paths.extend((key,) + path for path in value.set_paths())
+            self._set_paths = frozenset(paths)
+        return self._set_paths
+
+    def require_paths(self):
+        return self.set_paths(), ()
+
+    def __le__(self, target):
+        return self._check_include(target)
+
+    def __ge__(self, target):
+        return target._check_include(self)
+
+    def _check_include(self, target):
+        for key, value in self._childs:
+            if value.data and (key not in target.keys() or not target[key].data):
+                return False
+            if not value._check_include(target[key]):
+                return False
+        return True
+
+    def __reduce__(self):
+        return (self.__class__, (self.data, self._childs))
+
+
+EnvState.EMPTY = EnvState()
+
+
+class TransitionCache(object):
+    """
+    LRU cache which map (EnvState, func) to the transfered EnvState,
+    the functions which cannot be used in the state are cached too
+    """
+    NOT_SUIT = 'not suit'
+
+    def __init__(self, max_size=262144):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, state, func):
+        """
+        return the cached transfered state, NOT_SUIT Or Null if not cached
+        """
+        key = (state, func)
+        try:
+            new_state = self._cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            return
+        self.hits += 1
+        self._cache[key] = new_state
+        return new_state
+
+    def add(self, state, func, new_state):
+        """
+        cache the transfered state, None means the func is not suit
+        """
+        if new_state is None:
+            new_state = self.NOT_SUIT
+        if len(self._cache) >= self.max_size:
+            self._cache.popitem(last=False)
+        self._cache[(state, func)] = new_state
+
+    def transfer(self, state, func):
+        """
+        return transfered state Or Null if not suit
+        """
+        new_state = self.get(state, func)
+        if new_state is None:
+            new_state = state._gen_transfer_env(func)
+            self.add(state, func, new_state)
+        if new_state is self.NOT_SUIT:
+            return
+        return new_state
+
+    def clear(self):
+        """
+        NOTICE: need clear the cache if the depends of a function changed
+        """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "<%s size=%d hits=%d misses=%d>" % (self.__class__.__name__,
+                                                   len(self), self.hits, self.misses)
+
+
+TRANSITION_CACHE = TransitionCache()
+
+
+class PersistentEnv(object):
+    """
+    Copy-on-write Env which store the tree in EnvState nodes. All the
+    PersistentEnv from the same root share a root cell, a change rebuilds
+    the nodes on the modified path and replaces the root in the cell, so a
+    copy is O(1) and a change is O(depth).
+
+    NOTICE: like EnvState, the data is kept as bool
+    """
+    def __init__(self, state=None, root=None, path=()):
+        if root is None:
+            root = [EnvState.from_env(state) if state is not None else EnvState.EMPTY]
+        self._root = root
+        self._path = path
+
+    def freeze(self):
+        state = self._root[0]
+        for key in self._path:
+            state = state[key]
+        return state
+
+    def _update(self, func):
+        self._root[0] = self._root[0].update(self._path, func)
+
+    @property
+    def data(self):
+        return self.freeze().data
+
+    @data.setter
+    def data(self, value):
+        self._update(lambda node: node.with_data(value))
+
+    @property
+    def childs(self):
+        return dict((key, self.__class__(root=self._root, path=self._path + (key,)))
+                    for key in self.freeze().keys())
+
+    @childs.setter
+    def childs(self, value):
+        childs = []
+        for key, child in value.items():
+            state = EnvState.from_env(child)
+            if state is not EnvState.EMPTY:
+                childs.append((key, state))
+        self._update(lambda node: EnvState(node.data, tuple(sorted(childs))))
+
+    def keys(self):
+        return self.freeze().keys()
+
+    def values(self):
+        return self.childs.values()
+
+    def items(self):
+        return self.childs.items()
+
+    def __getitem__(self, key):
+        if key.startswith("_") and key not in self.keys():
+            return
+        return self.__class__(root=self._root, path=self._path + (key,))
+
+    def __setitem__(self, key, value):
+        self[key]._set(value)
+
+    def _set(self, value):
+        if isinstance(value, (Env, EnvState, PersistentEnv)):
+            state = EnvState.from_env(value)
+            self._update(lambda node: state)
+        else:
+            self.data = value
+
+    def get_data(self, path):
+        return self.__class__(root=self._root, path=self._path + compile_path(path))
+
+    def set_data(self, path, value):
+        LOGGER.debug('Env %s set_data, path: %s, value: %s', self, path, value)
+        self.get_data(path)._set(value)
+
+    def copy(self):
+        return self.__class__(self.freeze())
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def hit_require(self, depend):
+        return self.freeze().hit_require(depend)
+
+    def hit_requires(self, depends):
+        return self.freeze().hit_requires(depends)
+
+    def call_effect_env(self, objs):
+        for obj in objs:
+            obj.effect_env(self)
+
+    def gen_transfer_env(self, func):
+        """
+        return transfered env Or Null if not suit
+        """
+        new_state = TRANSITION_CACHE.transfer(self.freeze(), func)
+        if new_state is None:
+            return
+        return self.__class__(new_state)
+
+    def struct_table(self):
+        return self.freeze().struct_table()
+
+    def __str__(self):
+        return self.struct_table()
+
+    def __repr__(self):
+        return "<%s path='%s' data='%s'>" % (self.__class__.__name__,
+                                             '.'.join(self._path), self.data)
+
+    def __hash__(self):
+        return hash(self.freeze())
+
+    def __eq__(self, target):
+        return self.freeze() == target
+
+    def __ne__(self, target):
+        return not self.__eq__(target)
+
+    def __len__(self):
+        return len(self.freeze())
+
+    def __le__(self, target):
+        return self.freeze()._check_include(target)
+
+    def __ge__(self, target):
+        return target._check_include(self.freeze())
@@ -0,0 +1,106 @@
+"""
+Integer id based graph, the states and the functions of the depend graph
+get dense ids so the graph algorithms can work on small ints
+"""
+
+
+class IdRegistry(object):
+    """
+    Give the objects dense int ids, lookup in both directions
+    """
+    def __init__(self, objs=None):
+        self._ids = {}
+        self._objs = []
+        for obj in objs or ():
+            self.add(obj)
+
+    def __len__(self):
+        return len(self._objs)
+
+    def __iter__(self):
+        return iter(self._objs)
+
+    def __contains__(self, obj):
+        return obj in self._ids
+
+    def add(self, obj):
+        """
+        return the id of the obj, register it if it is a new one
+        """
+        obj_id = self._ids.get(obj)
+        if obj_id is None:
+            obj_id = self._ids[obj] = len(self._objs)
+            self._objs.append(obj)
+        return obj_id
+
+    def id(self, obj):
+        return self._ids[obj]
+
+    def get_id(self, obj, default=None):
+        return self._ids.get(obj, default)
+
+    def obj(self, obj_id):
+        return self._objs[obj_id]
+
+
+class IdGraph(object):
+    """
+    The depend graph with node ids and edge ids:
+    {src node id: {tgt node id: set(edge ids)}}
+    """
+    def __init__(self, dep_graph=None):
+        self.nodes = IdRegistry()
+        self.edges = IdRegistry()
+        self._graph = {}
+        if dep_graph:
+            for node in dep_graph:
+                self.add_node(node)
+            for node, datas in dep_graph.items():
+                for tgt_node, funcs in datas.items():
+                    for func in funcs:
+                        self.add_edge(node, tgt_node, func)
+
+    def __len__(self):
+        return len(self._graph)
+
+    def __iter__(self):
+        return iter(self._graph)
+
+    def __contains__(self, node_id):
+        return node_id in self._graph
+
+    def __getitem__(self, node_id):
+        return self._graph[node_id]
+
+    def keys(self):
+        return self._graph.keys()
+
+    def items(self):
+        return self._graph.items()
+
+    def add_node(self, node):
+        node_id = self.nodes.add(node)
+        self._graph.setdefault(node_id, {})
+        return node_id
+
+    def add_edge(self, src_node, tgt_node, data):
+        src_id = self.add_node(src_node)
+        tgt_id = self.add_node(tgt_node)
+        edge_id = self.edges.add(data)
+        self._graph[src_id].setdefault(tgt_id, set()).add(edge_id)
+        return edge_id
+
+    def node_id(self, node):
+        return self.nodes.id(node)
+
+    def node(self, node_id):
+        return self.nodes.obj(node_id)
+
+    def edge_id(self, data):
+        return self.edges.id(data)
+
+    def edge(self, edge_id):
+        return self.edges.obj(edge_id)
+
+    def restore_edges(self, edge_ids):
+        return [self.edges.obj(edge_id) for edge_id in edge_ids]
@@ -2,12 +2,15 @@
 Helpers which help handle the runner result and extend the runner function
 """
 
+import heapq
 import itertools
 import contextlib
+import random
 import traceback
 
 from .test_object import MistClearException, TestEndException, StaticMist, MistDeadEndException, is_TestObject
 from .case import Case
+from .case_generator import NWiseCaseSelector
 from .log import get_logger
 
 LOGGER = get_logger(__name__)
@@ -152,6 +155,38 @@ class MistsHandler(object):
             # TODO: check if it is func
             return self._case_gen.gen_cases(test_func, need_cleanup=need_cleanup)
 
+    def gen_shortest_cases(self, test_func, need_cleanup=None, max_cases=None):
+        if isinstance(test_func, StaticMist):
+            cases = self._find_mist_routes(test_func, with_name=False)
+            if max_cases:
+                return iter(heapq.nsmallest(max_cases, cases))
+            return iter(sorted(cases))
+        else:
+            return self._case_gen.gen_shortest_cases(test_func, max_cases=max_cases,
+                                                     need_cleanup=need_cleanup)
+
+    def gen_sample_cases(self, test_func, sample_num, seed=None, need_cleanup=None):
+        if isinstance(test_func, StaticMist):
+            cases = list(self._find_mist_routes(test_func, with_name=False))
+            rand = random.Random(seed)
+            return iter(rand.sample(cases, min(sample_num, len(cases))))
+        else:
+            return self._case_gen.gen_sample_cases(test_func, sample_num, seed=seed,
+                                                   need_cleanup=need_cleanup)
+
+    def gen_cover_cases(self, test_func, need_cleanup=None):
+        if isinstance(test_func, StaticMist):
+            return iter(sorted(self._find_mist_routes(test_func, with_name=False)))
+        else:
+            return self._case_gen.gen_cover_cases(test_func, need_cleanup=need_cleanup)
+
+    def gen_nwise_cases(self, test_func, n=2, need_cleanup=None):
+        if isinstance(test_func, StaticMist):
+            cases = sorted(self._find_mist_routes(test_func, with_name=False))
+            return NWiseCaseSelector(n).select(cases)
+        else:
+            return self._case_gen.gen_nwise_cases(test_func, n, need_cleanup=need_cleanup)
+
     def gen_cleanups(self, src_env, tgt_env):
         return self._case_gen.gen_cleanups(src_env, tgt_env)
 
@@ -3,7 +3,7 @@ Helper classes to help run test case
 """
 
 from .log import get_logger
-from .env import Env
+from .env import Env, EnvState
 from .dependency import get_all_depend, Consumer
 from .test_object import TestEndException, ObjectFailedException, CleanUpMethod
 
@@ -22,6 +22,8 @@ class Runner(object):
         self.doc_logger = doc_logger
         self._doc_funcs = doc_funcs
         self._extra_handler = None
+        # checkpoints which suit the env, keyed by env state
+        self._checkpoints_cache = {}
 
     def full_logger(self, msg):
         self.test_logger.info(msg)
@@ -31,12 +33,15 @@ class Runner(object):
         self._extra_handler = extra_handler
 
     def find_checkpoints(self):
-        ret = []
-        for func in self._checkpoints:
-            requires = get_all_depend(func, depend_cls=Consumer)
-            if self.env.hit_requires(requires):
-                ret.append(func)
-        return ret
+        state = self.env.freeze()
+        if state not in self._checkpoints_cache:
+            ret = []
+            for func in self._checkpoints:
+                requires = get_all_depend(func, depend_cls=Consumer)
+                if state.hit_requires(requires):
+                    ret.append(func)
+            self._checkpoints_cache[state] = ret
+        return list(self._checkpoints_cache[state])
 
     def _get_doc_func(self, func):
         # FIXME: this is check for mist class
@@ -127,7 +132,7 @@ class Runner(object):
                     extra_cases.setdefault(cases_name, []).append(case)
             cleanup_steps = case.clean_ups
         except TestEndException:
-            cleanup_steps = self._extra_handler.gen_cleanups(self.env, Env())
+            cleanup_steps = self._extra_handler.gen_cleanups(self.env.freeze(), EnvState.EMPTY)
         except ObjectFailedException as e:
             # TODO: maybe need clean up
             LOGGER.error('Case %s failed at step %s: %s', case, step_index, e)
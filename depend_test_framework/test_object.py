@@ -4,7 +4,7 @@ Test object related class
 import enum
 
 from .base_class import Entrypoint, check_func_entrys
-from .env import Env
+from .env import Env, EnvState
 
 from .log import get_logger
 
@@ -115,6 +115,7 @@ class Mist(object):
         self.func = func
         self.doc_func = doc_func
         self._areas = {}
+        self._reach_cache = {}
         for name, data in area.items():
             self.add_area_env(name, *data)
 
@@ -126,14 +127,24 @@ class Mist(object):
         env.call_effect_env(end)
         end_env = env
         self._areas[name] = (start_env, end_env)
+        self._reach_cache = {}
 
     def reach(self, env, func, new_env=None):
-        if not new_env:
-            new_env = env.gen_transfer_env(func)
+        state = EnvState.from_env(env)
+        if new_env is None:
+            new_state = state.gen_transfer_env(func)
+        else:
+            new_state = EnvState.from_env(new_env)
+        key = (state, new_state)
+        if key not in self._reach_cache:
+            self._reach_cache[key] = self._reach(state, new_state)
+        return self._reach_cache[key]
+
+    def _reach(self, state, new_state):
         for name, data in self._areas.items():
             start_env, end_env = data
-            LOGGER.debug('Start env: %s End env: %s env: %s New env: %s', start_env, end_env, env, new_env)
-            if start_env <= env and end_env <= new_env:
+            LOGGER.debug('Start env: %s End env: %s env: %s New env: %s', start_env, end_env, state, new_state)
+            if start_env <= state and new_state is not None and end_env <= new_state:
                 return name
 
     def __call__(self, *args, **kwargs):
@@ -1,4 +1,5 @@
 import pytest
+import itertools
 import os
 import sys
 
@@ -9,10 +10,15 @@ if os.path.isdir(os.path.join(BASEDIR, 'depend_test_framework')):
     os.environ['PATH'] += ":" + os.path.join(BASEDIR, 'tests')
     sys.path.insert(0, BASEDIR)
 
-from depend_test_framework.case_generator import DependGraphCaseGenerator
+from depend_test_framework.case_generator import DependGraphCaseGenerator, SubsumptionIndex, CleanupPlanner
+from depend_test_framework.case_generator import NWiseCaseSelector, PartialOrderReducer
+import depend_test_framework.case_generator as case_generator_module
 from depend_test_framework.env import Env
 from depend_test_framework.test_object import Action, CheckPoint, TestObject
-from depend_test_framework.dependency import Provider, Consumer
+from depend_test_framework.dependency import Provider, Consumer, slice_funcs
+from depend_test_framework.algorithms import route_permutations, iter_route_permutations
+from depend_test_framework.algorithms import iter_routes_by_length, RouteCounter
+from depend_test_framework.algorithms import strongly_connected_components, condense_graph
 
 
 @Action.decorator(1)
@@ -54,6 +60,69 @@ def mock_func6(params, env):
     pass
 
 
+@Action.decorator(1)
+@Provider.decorator('test.obj4', Provider.SET)
+def mock_func7(params, env):
+    pass
+
+
+@Action.decorator(1)
+@Provider.decorator('t.x', Provider.SET)
+def mock_set_x(params, env):
+    pass
+
+
+@Action.decorator(1)
+@Consumer.decorator('t.x', Consumer.REQUIRE)
+@Provider.decorator('t.y', Provider.SET)
+@Provider.decorator('t.z', Provider.SET)
+def mock_set_yz(params, env):
+    pass
+
+
+@Action.decorator(1)
+@Consumer.decorator('t.x', Consumer.REQUIRE)
+@Provider.decorator('t.x', Provider.CLEAR)
+def mock_clear_x(params, env):
+    pass
+
+
+@Action.decorator(1)
+@Consumer.decorator('t.y', Consumer.REQUIRE)
+@Provider.decorator('t.y', Provider.CLEAR)
+def mock_clear_y(params, env):
+    pass
+
+
+@Action.decorator(1)
+@Consumer.decorator('t.z', Consumer.REQUIRE)
+@Provider.decorator('t.z', Provider.CLEAR)
+def mock_clear_z(params, env):
+    pass
+
+
+@Action.decorator(1)
+@Consumer.decorator('t.y', Consumer.REQUIRE)
+def mock_check_y(params, env):
+    pass
+
+
+CLEANUP_FUNCS = [mock_set_x, mock_set_yz, mock_clear_x, mock_clear_y, mock_clear_z]
+
+
+def check_cleanups(cases, test_func):
+    """
+    the cases must have cleanups which bring the env back to empty
+    """
+    assert cases
+    for case in cases:
+        assert case.cleanups
+        e = Env()
+        for step in list(case.steps) + [test_func] + list(case.clean_ups):
+            e = e.gen_transfer_env(step)
+        assert not e.freeze().set_paths()
+
+
 def test_gen_cases_method():
     test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
     case_generator = DependGraphCaseGenerator()
@@ -92,6 +161,18 @@ def test_gen_cases_special_method():
         assert e >= end_env
         assert hit_start > 0
 
+    # the routes are streamed, the first case comes before the others are found
+    iter_routes = case_generator.iter_route_permutations
+
+    def first_route(*args, **kwargs):
+        for route in iter_routes(*args, **kwargs):
+            yield route
+            raise AssertionError('routes are not streamed')
+
+    case_generator.iter_route_permutations = first_route
+    cases = case_generator.gen_cases_special(src_env, start_env, end_env)
+    assert next(cases).steps
+
 
 def test_mapping_perfermance():
 
@@ -110,3 +191,409 @@ def test_mapping_perfermance():
             list(g2.gen_cases(mock_func6))
 
     # assert rw1.run_time < rw2.run_time
+
+
+def test_bitset_depend_map():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    g1 = DependGraphCaseGenerator()
+    g1.gen_depend_map(test_funcs)
+    g2 = DependGraphCaseGenerator(use_bitset=True)
+    g2.gen_depend_map(test_funcs)
+
+    assert g1.dep_graph == g2.dep_graph
+    assert len(list(g2.gen_cases(mock_func4))) == 2
+    assert len(list(g2.gen_cases(mock_func6))) == 6
+
+    # a start state with a path which no function use
+    start_node = Env()
+    start_node.set_data('other.leaf', True)
+    test_funcs = [mock_func1, mock_func2, mock_func3]
+    g1.gen_depend_map(test_funcs, start_node=start_node)
+    assert len(g1.dep_graph) == 4
+    for processes in (None, 2):
+        g2.gen_depend_map(test_funcs, start_node=start_node, processes=processes)
+        assert g2.dep_graph == g1.dep_graph
+
+
+def test_subsumption_index():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    index = SubsumptionIndex(case_generator.dep_graph)
+    assert len(index) == len(case_generator.dep_graph)
+
+    e = Env()
+    e.set_data('test.obj1', True)
+    e.set_data('test.obj3', False)
+    patterns = [Env(), e]
+    for func in test_funcs:
+        patterns.extend(Env.gen_require_env(func))
+    for pattern in patterns:
+        states = [state for state in case_generator.dep_graph if pattern <= state]
+        assert index.find(pattern) == sorted(states, key=len)
+
+
+def test_save_load_dep_graph(tmpdir):
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    g1 = DependGraphCaseGenerator()
+    g1.gen_depend_map(test_funcs)
+    cache_file = g1.save_dep_graph(str(tmpdir))
+    assert os.path.isfile(cache_file)
+
+    g2 = DependGraphCaseGenerator()
+    assert not g2.load_dep_graph(str(tmpdir), test_funcs[:-1])
+    assert not g2.load_dep_graph(str(tmpdir), test_funcs, drop_env=2)
+    assert g2.load_dep_graph(str(tmpdir), list(reversed(test_funcs)))
+    assert g2.dep_graph == g1.dep_graph
+    assert list(g2.dep_graph) == list(g1.dep_graph)
+    assert len(list(g2.gen_cases(mock_func4))) == 2
+    assert len(list(g2.gen_cases(mock_func6))) == 6
+
+
+def test_add_remove_test_funcs():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    g1 = DependGraphCaseGenerator()
+    g1.gen_depend_map(test_funcs)
+
+    g2 = DependGraphCaseGenerator()
+    g2.gen_depend_map([mock_func2, mock_func3, mock_func6])
+    g2.add_test_funcs([mock_func1, mock_func4, mock_func5])
+    assert g2.dep_graph == g1.dep_graph
+    assert len(list(g2.gen_cases(mock_func4))) == 2
+    assert len(list(g2.gen_cases(mock_func6))) == 6
+
+    g3 = DependGraphCaseGenerator()
+    g3.gen_depend_map([mock_func1, mock_func2, mock_func3, mock_func5])
+    g1.remove_test_funcs([mock_func4, mock_func6])
+    assert g1.dep_graph == g3.dep_graph
+    g1.remove_test_funcs([mock_func2])
+    assert list(g1.dep_graph) == [Env().freeze()]
+
+
+def test_parallel_depend_map(monkeypatch):
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    g1 = DependGraphCaseGenerator()
+    g1.gen_depend_map(test_funcs)
+    g2 = DependGraphCaseGenerator()
+    g2.gen_depend_map(test_funcs, processes=2)
+    g3 = DependGraphCaseGenerator(use_bitset=True)
+    g3.gen_depend_map(test_funcs, processes=3)
+
+    assert g2.dep_graph == g1.dep_graph
+    assert g3.dep_graph == g1.dep_graph
+    assert list(g2.dep_graph) == list(g3.dep_graph)
+    assert len(list(g2.gen_cases(mock_func6))) == 6
+
+    # the workers cannot be forked, the graph is expanded in one process
+    monkeypatch.setattr(case_generator_module, '_get_fork_context', lambda: None)
+    g4 = DependGraphCaseGenerator()
+    g4.gen_depend_map(test_funcs, processes=2)
+    assert g4.dep_graph == g1.dep_graph
+
+
+def test_iter_route_permutations():
+    graph = {'s': {'u': 'a', 'x': 'b'},
+             'u': {'v': 'c', 'x': 'd'},
+             'v': {'y': 'e'},
+             'x': {'u': 'f', 'v': 'g', 'y': 'h'},
+             'y': {'s': 'i', 'v': 'j'}}
+    routes = iter_route_permutations(graph, 's', 'y')
+    assert not isinstance(routes, list)
+    routes = list(routes)
+    assert sorted(routes) == sorted([['a', 'c', 'e'], ['a', 'd', 'g', 'e'], ['a', 'd', 'h'],
+                                     ['b', 'f', 'c', 'e'], ['b', 'g', 'e'], ['b', 'h']])
+    assert routes == route_permutations(graph, 's', 'y')
+    assert sorted(iter_route_permutations(graph, 's', 'y', allow_dep=3)) == [['a', 'c', 'e'], ['a', 'd', 'h'],
+                                                                           ['b', 'g', 'e'], ['b', 'h']]
+    assert list(iter_route_permutations(graph, 's', 'y', trace=['x'])) == [['a', 'c', 'e']]
+
+    # a deep graph which is over the recursion limit
+    num = sys.getrecursionlimit() + 100
+    graph = dict((i, {i + 1: i, 0: -i}) for i in range(num))
+    graph[num] = {}
+    assert list(iter_route_permutations(graph, 0, num)) == [list(range(num))]
+    assert list(iter_routes_by_length(graph, 0, num, num)) == [list(range(num))]
+
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    cases = [list(case.steps) for case in case_generator.gen_cases(mock_func6)]
+    first_cases = itertools.islice(case_generator.gen_cases(mock_func6), 3)
+    assert [list(case.steps) for case in first_cases] == cases[:3]
+
+
+def test_strongly_connected_components():
+    graph = {'s': {'u': 'a'},
+             'u': {'v': 'b', 'x': 'c'},
+             'v': {'u': 'd', 'y': 'e'},
+             'x': {'y': 'f'},
+             'y': {'x': 'g'}}
+    comps = strongly_connected_components(graph)
+    assert comps['u'] == comps['v']
+    assert comps['x'] == comps['y']
+    assert len(set(comps.values())) == 3
+    dag = condense_graph(graph, comps)
+    assert dag == {comps['s']: set([comps['u']]),
+                   comps['u']: set([comps['x']]),
+                   comps['x']: set()}
+    for node, nodes_map in graph.items():
+        for tgt_node in nodes_map:
+            assert comps[tgt_node] <= comps[node]
+
+    # a chain of diamonds, the counts are shared between the routes
+    num = 30
+    graph = {num: {}}
+    for i in range(num):
+        graph[i] = {('a', i): 'a', ('b', i): 'b'}
+        graph[('a', i)] = {i + 1: 'c'}
+        graph[('b', i)] = {i + 1: 'd'}
+    counter = RouteCounter(graph, num, allow_dep=3 * num)
+    assert counter.count(0) == 2 ** num
+    assert len(counter._memo) < 3 * num * 2 * num
+    routes = iter_route_permutations(graph, 0, num, allow_dep=2 * num)
+    assert next(routes) == ['a', 'c'] * num
+
+
+def test_gen_shortest_cases():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+
+    for test_func in (mock_func4, mock_func6):
+        cases = list(case_generator.gen_shortest_cases(test_func))
+        step_nums = [case.step_num for case in cases]
+        assert step_nums == sorted(step_nums)
+        assert len(set(tuple(case.steps) for case in cases)) == len(cases)
+        for case in cases:
+            e = Env()
+            for step in case.steps:
+                e = e.gen_transfer_env(step)
+            assert e.gen_transfer_env(test_func) is not None
+
+        first_cases = list(case_generator.gen_shortest_cases(test_func, max_cases=2))
+        assert [list(case.steps) for case in first_cases] == [list(case.steps) for case in cases[:2]]
+    assert len(list(case_generator.gen_shortest_cases(mock_func4))) == 2
+
+
+def test_gen_cleanups():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    clean_env = Env().freeze()
+
+    for env in case_generator.dep_graph:
+        routes = case_generator.compute_route_permutations(clean_env, env, True)
+        steps = case_generator.gen_cleanups(env, clean_env)
+        random_steps = case_generator.gen_cleanups(env, clean_env, True)
+        if not routes:
+            assert steps is None
+            continue
+        assert len(steps) == min(len(route) for route in routes)
+        assert len(random_steps) == len(steps)
+        for cleanup_steps in (steps, random_steps):
+            e = env
+            for step in cleanup_steps:
+                e = e.gen_transfer_env(step)
+            assert e == clean_env
+
+    # only mock_func3 can clear test.obj1, so it is used even if it is expensive
+    planner = CleanupPlanner(case_generator.dep_graph,
+                             lambda func: 10 if func is mock_func3 else 1)
+    env = Env()
+    env.set_data('test.obj1', True)
+    env = env.freeze()
+    assert planner.plan(env, clean_env) == [mock_func3]
+    assert planner.costs(clean_env)[env] == 10
+
+
+def test_count_cases():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    for use_map in (True, False):
+        case_generator = DependGraphCaseGenerator(use_map=use_map)
+        case_generator.gen_depend_map(test_funcs)
+        for test_func in test_funcs:
+            cases = list(case_generator.gen_shortest_cases(test_func))
+            assert case_generator.count_cases(test_func) == len(cases)
+
+
+def test_gen_sample_cases():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    all_cases = set(tuple(case.steps) for case in case_generator.gen_shortest_cases(mock_func6))
+
+    cases = [tuple(case.steps) for case in case_generator.gen_sample_cases(mock_func6, 2, seed=1)]
+    assert len(set(cases)) == 2
+    assert set(cases) <= all_cases
+    assert cases == [tuple(case.steps) for case in
+                     case_generator.gen_sample_cases(mock_func6, 2, seed=1)]
+
+    cases = [tuple(case.steps) for case in case_generator.gen_sample_cases(mock_func6, 100)]
+    assert set(cases) == all_cases
+
+
+def test_gen_cover_cases():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+
+    def _get_edges(cases):
+        edges = set()
+        for case in cases:
+            e = Env().freeze()
+            for step in case.steps:
+                new_e = e.gen_transfer_env(step)
+                edges.add((e, step, new_e))
+                e = new_e
+            assert e == case.tgt_env
+        return edges
+
+    for test_func in (mock_func4, mock_func6):
+        all_cases = list(case_generator.gen_shortest_cases(test_func))
+        cases = list(case_generator.gen_cover_cases(test_func))
+        assert len(cases) <= len(all_cases)
+        assert _get_edges(cases) >= _get_edges(all_cases)
+
+
+def test_gen_nwise_cases():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    all_cases = list(case_generator.gen_shortest_cases(mock_func6))
+
+    for n in (1, 2, 3):
+        cases = list(case_generator.gen_nwise_cases(mock_func6, n))
+        assert 0 < len(cases) <= len(all_cases)
+        selector = NWiseCaseSelector(n)
+        for case in cases:
+            assert selector.add(case)
+        for case in all_cases:
+            assert not selector.add(case)
+
+
+def test_partial_order_reduction():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func6]
+    g1 = DependGraphCaseGenerator()
+    g1.gen_depend_map(test_funcs)
+    g2 = DependGraphCaseGenerator(use_por=True)
+    g2.gen_depend_map(test_funcs)
+    reducer = PartialOrderReducer()
+    assert reducer.independent(mock_func2, mock_func5)
+    assert not reducer.independent(mock_func2, mock_func3)
+    assert not reducer.independent(mock_func1, mock_func2)
+
+    for test_func in (mock_func4, mock_func6):
+        for gen_cases in ('gen_cases', 'gen_shortest_cases'):
+            cases = set(tuple(case.steps) for case in getattr(g1, gen_cases)(test_func))
+            reduced = set(tuple(case.steps) for case in getattr(g2, gen_cases)(test_func))
+            assert reduced <= cases
+            normal_forms = set(tuple(reducer.normal_form(steps)) for steps in reduced)
+            for steps in cases:
+                assert tuple(reducer.normal_form(steps)) in normal_forms
+
+
+def test_slice_funcs_cleanups():
+    # the writes of mock_set_yz are cleared by the cleanups
+    assert slice_funcs([mock_check_y], CLEANUP_FUNCS) == CLEANUP_FUNCS
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(slice_funcs([mock_check_y], CLEANUP_FUNCS))
+    check_cleanups(list(case_generator.gen_cases(mock_check_y, need_cleanup=True)),
+                   mock_check_y)
+
+
+def test_minimize_depend_map():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func7]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    graph_size = len(case_generator.dep_graph)
+    full_cases = set(tuple(case.steps) for case in case_generator.gen_cases(mock_func6))
+
+    case_generator.minimize_depend_map([mock_func6])
+    # obj4 is never consumed, the states which only differ in it are merged
+    assert len(case_generator.dep_graph) < graph_size
+    cases = list(case_generator.gen_cases(mock_func6, need_cleanup=True))
+    assert cases
+    assert set(tuple(case.steps) for case in cases) <= full_cases
+    for case in cases:
+        e = Env()
+        for step in case.steps:
+            e = e.gen_transfer_env(step)
+        assert e == case.tgt_env
+        assert e.gen_transfer_env(mock_func6)
+    assert case_generator.count_cases(mock_func6) == len(list(
+        case_generator.gen_shortest_cases(mock_func6)))
+    with pytest.raises(Exception):
+        case_generator.add_test_funcs([mock_func6])
+
+
+def test_slice_funcs():
+    test_funcs = [mock_func1, mock_func2, mock_func3, mock_func4, mock_func5, mock_func7]
+    assert slice_funcs([mock_func6], test_funcs) == test_funcs[:5]
+    funcs = slice_funcs([mock_func1], test_funcs)
+    assert funcs == [mock_func1, mock_func2, mock_func3, mock_func5]
+    # the paths of the mist areas keep their functions too
+    mist_env = Env()
+    mist_env.set_data('test.obj4', True)
+    funcs = slice_funcs([mock_func1], test_funcs, mist_env.require_paths()[0])
+    assert funcs == [mock_func1, mock_func2, mock_func3, mock_func5, mock_func7]
+
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(test_funcs)
+    full_cases = set(tuple(case.steps) for case in case_generator.gen_cases(mock_func6))
+    case_generator.gen_depend_map(slice_funcs([mock_func6], test_funcs))
+    cases = set(tuple(case.steps) for case in case_generator.gen_cases(mock_func6))
+    assert cases == set(steps for steps in full_cases if mock_func7 not in steps)
+
+
+def test_projected_depend_map():
+    test_funcs = CLEANUP_FUNCS + [mock_func7]
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(slice_funcs([mock_check_y], test_funcs))
+    graph_size = len(case_generator.dep_graph)
+
+    case_generator.gen_depend_map(test_funcs, targets=[mock_check_y])
+    # t.z is written but never read on the way to mock_check_y, the states
+    # are projected without it and mock_clear_z is only used to clean up
+    assert len(case_generator.dep_graph) < graph_size
+    assert mock_clear_z not in case_generator._graph_funcs
+    cases = list(case_generator.gen_cases(mock_check_y, need_cleanup=True))
+    check_cleanups(cases, mock_check_y)
+    assert any(mock_clear_z in case.clean_ups for case in cases)
+    check_cleanups(list(case_generator.gen_shortest_cases(mock_check_y, need_cleanup=True)),
+                   mock_check_y)
+    assert case_generator.count_cases(mock_check_y) == len(list(
+        case_generator.gen_shortest_cases(mock_check_y)))
+
+    # a concrete env which have obj4 set is projected into the graph
+    src_env = Env().gen_transfer_env(mock_func7)
+    cases = list(case_generator.gen_cases(mock_check_y, need_cleanup=True, src_env=src_env))
+    assert cases
+    for case in cases:
+        e = src_env
+        for step in case.steps:
+            e = e.gen_transfer_env(step)
+        assert e == case.tgt_env
+        for step in [mock_check_y] + list(case.clean_ups):
+            e = e.gen_transfer_env(step)
+        assert e.freeze() == src_env.freeze()
+
+
+def test_projected_minimized_depend_map():
+    case_generator = DependGraphCaseGenerator()
+    case_generator.gen_depend_map(CLEANUP_FUNCS + [mock_func7], targets=[mock_check_y])
+    graph_size = len(case_generator.dep_graph)
+    case_generator.minimize_depend_map([mock_check_y])
+    assert len(case_generator.dep_graph) <= graph_size
+
+    # the projector is kept, obj4 is still projected out of the graph
+    src_env = Env().gen_transfer_env(mock_func7)
+    cases = list(case_generator.gen_cases(mock_check_y, need_cleanup=True, src_env=src_env))
+    assert cases
+    for case in cases:
+        e = src_env
+        for step in case.steps:
+            e = e.gen_transfer_env(step)
+        assert e == case.tgt_env
+        for step in [mock_check_y] + list(case.clean_ups):
+            e = e.gen_transfer_env(step)
+        assert e.freeze() == src_env.freeze()
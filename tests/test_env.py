@@ -1,13 +1,15 @@
 import pytest
 import os
 import sys
+import copy
 
 BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if os.path.isdir(os.path.join(BASEDIR, 'depend_test_framework')):
     os.environ['PATH'] += ":" + os.path.join(BASEDIR, 'tests')
     sys.path.insert(0, BASEDIR)
 
-from depend_test_framework.env import Env
+from depend_test_framework.env import Env, EnvState, PersistentEnv, TransitionCache, TRANSITION_CACHE
+from depend_test_framework.dependency import Provider, Consumer, compile_path
 
 
 def test_env():
@@ -39,3 +41,146 @@ def test_env():
     e3.set_data('a.c', e4)
     assert e3.struct_table() == "{ a|False: { c|False: { d|True: {},},},}"
     assert e3.get_data('a.c.d').__repr__() == "<Env path='a.c.d' data='True'>"
+
+
+def test_env_state():
+    e1 = Env()
+    e1.set_data('a.c', 1)
+    e1.set_data('a.b', False)
+    e2 = Env()
+    e2.set_data('a.c', True)
+    s1 = e1.freeze()
+    assert s1 is e2.freeze()
+    assert s1 is EnvState.from_env(s1)
+    assert s1 == e1 and e1 == s1
+    assert hash(s1) == hash(e1)
+    assert s1.struct_table() == e1.struct_table()
+    assert len(s1) == 1
+    assert s1['a']['c'].data
+    assert s1['x'] is EnvState.EMPTY
+    assert Env().freeze() is EnvState.EMPTY
+
+    e3 = s1.to_env()
+    assert e3.struct_table() == e1.struct_table()
+    assert e3['a']['c'].__repr__() == "<Env path='a.c' data='True'>"
+    e3.set_data('a.d', True)
+    assert e3.freeze() is not s1
+    assert e3.freeze() >= e2
+    assert not s1 >= e3
+    assert {s1: 1}[e2] == 1
+
+
+def test_persistent_env():
+    e = Env()
+    e.set_data('a.c', True)
+    e.set_data('b', True)
+    p1 = PersistentEnv(e.freeze())
+    p2 = copy.deepcopy(p1)
+    p2.set_data('a.d', True)
+    assert p1 == e
+    assert p2.struct_table() == "{ a|False: { c|True: {}, d|True: {},}, b|True: {},}"
+    assert p2.freeze()['b'] is p1.freeze()['b']
+
+    sub_env = p2.get_data('a')
+    sub_env.childs = {}
+    assert not sub_env.data
+    assert p2.struct_table() == "{ b|True: {},}"
+    p2['a'] = p1.get_data('a')
+    p2.get_data('a').data = True
+    assert p2.get_data('a.c').data
+    assert p2.struct_table() == "{ a|True: { c|True: {},}, b|True: {},}"
+    assert len(p2) == 2
+    assert p1.struct_table() == e.struct_table()
+    assert p2.get_data('a.c').__repr__() == "<PersistentEnv path='a.c' data='True'>"
+
+    e2 = Env()
+    e2.set_data('a.c', e)
+    e3 = copy.deepcopy(e2.get_data('a.c'))
+    assert e3.parent is None
+    assert e3['a'].parent is e3
+    assert e3.struct_table() == e.struct_table()
+
+
+def test_env_state_cache():
+    e = Env()
+    e.set_data('a.b.c', True)
+    s1 = e.freeze()
+    assert len(e) == 1 and e.need_fmt()
+    sub_env = e.get_data('a.b')
+    sub_env['d'] = True
+    assert e.freeze() is not s1
+    assert len(e) == 2
+    sub_env.childs = {}
+    assert not e.need_fmt()
+    assert e.freeze() is EnvState.EMPTY
+
+    e.set_data('x', {})
+    assert e.struct_table() == '{}'
+    e.get_data('x').data['key'] = 'value'
+    assert e.struct_table() == '{ x|True: {},}'
+
+    e = Env()
+    e.set_data('a', True)
+    e2 = Env()
+    e2.set_data('x', e)
+    e.set_data('a', False)
+    assert e.struct_table() == '{}' and len(e) == 0
+    assert e2.get_data('x.a').data is True
+    assert e2.get_data('x.a').parent is e2.get_data('x')
+
+
+def test_transition_cache():
+    @Provider.decorator('a.b', Provider.SET)
+    def set_func(params, env):
+        pass
+
+    @Consumer.decorator('a', Consumer.REQUIRE)
+    @Provider.decorator('a', Provider.CLEAR)
+    def clear_func(params, env):
+        pass
+
+    cache = TransitionCache(max_size=2)
+    state = EnvState.EMPTY
+    new_state = cache.transfer(state, set_func)
+    assert new_state.struct_table() == '{ a|False: { b|True: {},},}'
+    assert cache.transfer(state, clear_func) is None
+    assert cache.transfer(state, clear_func) is None
+    assert cache.transfer(state, set_func) is new_state
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert cache.transfer(new_state, clear_func) is new_state
+    assert len(cache) == 2
+    assert cache.transfer(state, clear_func) is None
+    assert cache.misses == 4
+
+    assert Env().gen_transfer_env(clear_func) is None
+    assert Env().gen_transfer_env(set_func) == new_state
+    assert PersistentEnv().gen_transfer_env(set_func).freeze() is new_state
+
+    # a Env step is applied once and seeds the cache for the states
+    TRANSITION_CACHE.clear()
+    env = Env().gen_transfer_env(set_func)
+    assert Env().gen_transfer_env(clear_func) is None
+    assert (TRANSITION_CACHE.hits, TRANSITION_CACHE.misses) == (0, 2)
+    assert EnvState.EMPTY.gen_transfer_env(set_func) is env.freeze()
+    assert EnvState.EMPTY.gen_transfer_env(clear_func) is None
+    assert (TRANSITION_CACHE.hits, TRANSITION_CACHE.misses) == (2, 2)
+
+
+def test_compiled_path():
+    path = compile_path('a.b.c')
+    assert path == ('a', 'b', 'c')
+    assert compile_path('a.b.c') is path
+    assert compile_path(('a', 'b', 'c')) is path
+    assert compile_path('') == ()
+
+    dep = Consumer('a.b|c', Consumer.REQUIRE)
+    assert dep.alternatives == (compile_path('a.b'), compile_path('c'))
+    assert hash(dep) == hash(Consumer('a.b|c', Consumer.REQUIRE))
+
+    e = Env()
+    e.set_data(path, True)
+    assert e.get_data('a.b.c').data
+    assert e.get_data(path) is e.get_data('a.b.c')
+    assert e.freeze().get_data(path).data
+    assert e.hit_require(Consumer('x|a.b', Consumer.REQUIRE))
+    assert not e.freeze().hit_require(Consumer('a|a.b', Consumer.REQUIRE_N))
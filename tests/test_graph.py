@@ -0,0 +1,42 @@
+import pytest
+import os
+import sys
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.isdir(os.path.join(BASEDIR, 'depend_test_framework')):
+    os.environ['PATH'] += ":" + os.path.join(BASEDIR, 'tests')
+    sys.path.insert(0, BASEDIR)
+
+from depend_test_framework.graph import IdRegistry, IdGraph
+
+
+def test_id_registry():
+    registry = IdRegistry(['a', 'b', 'a'])
+    assert len(registry) == 2
+    assert registry.add('c') == 2
+    assert registry.add('a') == 0
+    assert registry.id('b') == 1
+    assert registry.obj(2) == 'c'
+    assert registry.get_id('d') is None
+    assert 'c' in registry
+    assert list(registry) == ['a', 'b', 'c']
+
+
+def test_id_graph():
+    dep_graph = {'s': {'u': set(['f1']), 'x': set(['f2'])},
+                 'u': {'x': set(['f1', 'f3'])},
+                 'x': {}}
+    graph = IdGraph(dep_graph)
+    assert len(graph) == 3
+    for node, datas in dep_graph.items():
+        node_id = graph.node_id(node)
+        assert graph.node(node_id) == node
+        assert len(graph[node_id]) == len(datas)
+        for tgt_node, funcs in datas.items():
+            edge_ids = graph[node_id][graph.node_id(tgt_node)]
+            assert set(graph.restore_edges(edge_ids)) == funcs
+
+    edge_id = graph.add_edge('x', 'y', 'f2')
+    assert graph.edge(edge_id) == 'f2'
+    assert graph.node_id('y') == 3
+    assert graph[graph.node_id('x')] == {3: set([edge_id])}